@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+'''
+Compare the throughput of the archive's content hash algorithms.
+
+    python benchmarks/bench_hash.py [--count N] [--size BYTES ...]
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailarchive.hashing import ALGORITHMS, content_key
+
+
+def bench(algorithm, messages, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for content in messages:
+            content_key(algorithm, content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=2000, help="messages per size")
+    parser.add_argument("--size", type=int, action="append", default=None,
+                        help="message size in bytes (repeatable; default 4k, 64k and 1M)")
+    args = parser.parse_args()
+
+    sizes = args.size or [4 * 1024, 64 * 1024, 1024 * 1024]
+
+    print("%-10s %10s %12s %10s" % ("algorithm", "size", "msgs/s", "MB/s"))
+    for size in sizes:
+        count = max(1, min(args.count, (256 * 1024 * 1024) // size))
+        messages = [os.urandom(size) for _ in range(count)]
+        for algorithm in sorted(ALGORITHMS):
+            elapsed = bench(algorithm, messages)
+            print("%-10s %10d %12.0f %10.1f" % (algorithm, size, count / elapsed, count * size / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    main()
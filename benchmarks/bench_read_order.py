@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''
+Measure how fast a Maildir's messages can be read in each read order.
+
+    python benchmarks/bench_read_order.py MAILDIR [--order inode ...] [--prefetch N]
+
+Each file is dropped from the page cache (POSIX_FADV_DONTNEED) before every pass, so
+the numbers reflect the disk rather than memory.  Run it against a large folder on the
+storage you care about; on SSDs the orders should be close, on spinning disks they are not.
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailarchive.schedule import ReadScheduler, ORDERS, _advise
+
+
+def run(path, order, prefetch):
+    paths = dict((msgid, entry[0]) for msgid, entry in ReadScheduler(path, "inode")._scan().items())
+    msgids = sorted(paths)
+    for p in paths.values():
+        _advise(p, os.POSIX_FADV_DONTNEED)
+
+    scheduler = ReadScheduler(path, order, prefetch)
+    start = time.perf_counter()
+    total = 0
+    for msgid in (scheduler(msgids) if prefetch else scheduler.schedule(msgids)):
+        with open(paths[msgid], "rb") as f:
+            total += len(f.read())
+    return len(msgids), total, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("maildir")
+    parser.add_argument("--order", action="append", choices=ORDERS, default=None, help="orders to compare (default: all)")
+    parser.add_argument("--prefetch", type=int, default=64, help="prefetch depth (0 disables fadvise)")
+    args = parser.parse_args()
+
+    print("%-8s %10s %12s %10s %10s" % ("order", "messages", "seconds", "msgs/s", "MB/s"))
+    for order in args.order or ORDERS:
+        count, total, elapsed = run(args.maildir, order, args.prefetch)
+        print("%-8s %10d %12.2f %10.0f %10.1f" % (order, count, elapsed, count / elapsed, total / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''
+Compare the record store backends on the two access patterns that dominate.
+
+    python benchmarks/bench_store.py [--records N] [--backend lmdb ...] [--dir PATH]
+
+"lookup" is a no-op re-import: for every message, is its key known, and fetch the record
+(a mix of hits and misses).  "scan" is fsck's record pass: every key in order, then its
+value.  Each backend gets a fresh store in a temporary directory (or --dir, to measure the
+storage you care about).  Backends whose module is not installed are skipped.
+'''
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mailarchive.stores import BACKENDS, open_store, batch_write
+
+
+def records(count):
+    for i in range(count):
+        key = hashlib.sha1(b"%d" % i).hexdigest()
+        yield key, "/Archive/%d/INBOX::%d.M%dP1.host::S::%d.0::size=%d" % (2000 + i % 20, 1400000000 + i, i, 1400000000 + i, 2000 + i)
+
+
+def lookup(store, keys):
+    found = 0
+    start = time.perf_counter()
+    for key in keys:
+        if key in store:
+            store[key]
+            found += 1
+    return time.perf_counter() - start, found
+
+
+def scan(store):
+    count = 0
+    start = time.perf_counter()
+    for key in store:
+        store[key]
+        count += 1
+    return time.perf_counter() - start, count
+
+
+def run(backend, count, lookups, directory):
+    root = tempfile.mkdtemp(prefix="bench-store-", dir=directory)
+    try:
+        store = open_store(root, backend)
+
+        start = time.perf_counter()
+        batch_write(store, records(count))
+        load = time.perf_counter() - start
+
+        # Half the lookups hit, half miss, like a re-import of partly new mail.
+        keys = [key for key, value in records(count)]
+        probes = random.sample(keys, min(lookups // 2, count)) + [hashlib.sha1(b"miss%d" % i).hexdigest() for i in range(lookups // 2)]
+        random.shuffle(probes)
+
+        lookup_time, found = lookup(store, probes)
+        scan_time, scanned = scan(store)
+        if hasattr(store, "close"):
+            store.close()
+        return load, lookup_time, len(probes), scan_time, scanned
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=200000, help="records to load")
+    parser.add_argument("--lookups", type=int, default=200000, help="key lookups to time")
+    parser.add_argument("--backend", action="append", choices=sorted(BACKENDS), default=None,
+                        help="backends to compare (default: all)")
+    parser.add_argument("--dir", default=None, help="where to create the stores")
+    args = parser.parse_args()
+
+    print("%-8s %12s %14s %14s" % ("backend", "load rec/s", "lookup ops/s", "scan rec/s"))
+    for backend in args.backend or sorted(BACKENDS):
+        try:
+            load, lookup_time, lookups, scan_time, scanned = run(backend, args.records, args.lookups, args.dir)
+        except (ImportError, RuntimeError) as e:
+            print("%-8s skipped: %s" % (backend, e))
+            continue
+        print("%-8s %12.0f %14.0f %14.0f" % (backend, args.records / load, lookups / lookup_time, scanned / scan_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-__ALL__ = ["archive", "outputs", "progress"]
+__ALL__ = ["archive", "compression", "discovery", "durability", "export", "folderindex", "hashing", "ingest", "journal", "listing", "locking", "outputs", "pack", "progress", "schedule", "search", "shared", "sources", "stores", "throttle"]
@@ -1,15 +1,55 @@
+import errno
+import functools
+import itertools
 import logging
+import random
 import os                      # path
+import shutil
+import sys                     # intern()
+import time
+from array import array
+from bisect import bisect_left
 from datetime import datetime  # now()
 
 from .outputs import QuietOutput, StandardOutput, VerboseOutput, ADDED, UPDATED, EXISTING
+from .compression import CODECS, compress, decompress, sniff, codec_for_path, mark as mark_codec
+from .pack import Pack
+from .search import SearchIndex
+from .export import export_mbox, read_ahead, READ_BUFFER
+from .hashing import LEGACY, ALGORITHMS, content_key, algorithm_of, make_key
+from .listing import ListingCache
+from .journal import RepairJournal, plan_batches
+from .locking import ArchiveLock, enable_wal, retry_busy
+from .ingest import StreamedMessage, stream_copy, maildir_name
+from .sources import SourceMessage
+from .schedule import maildir_flags
+from .shared import SharedStore
+from .folderindex import FolderIndex
+from .durability import Durability
+from .stores import BACKENDS, open_store, copy_store
 
 from maildir_lite import Maildir
 from simplekvs import SQLiteStore as kvs
-# from simplekvs import SQLAlchemyStore as kvs
 
 log = logging.getLogger(__name__)
 
+# Version of the folder routing rules in _route() and _folder_name().  Records cache their
+# routing inputs under it; bump it whenever the rules change so fsck re-reads the headers.
+ROUTING_RULES = 1
+
+# Subfolder of the year folder for each kind of message _route() tells apart.
+KIND_FOLDERS = {"": "", "sent": "/Sent", "notes": "/Notes", "todo": "/Apple Mail To Do"}
+
+def exclusive(method):
+    '''Run a maintenance method under the archive's exclusive lock.'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Maintenance reads the store directly, so held-back records go in first.
+        self.flush()
+        with self.lock.exclusive():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 # Catch interrupts
 import signal
 class CancelHandler(object):
@@ -28,26 +68,83 @@ class CancelHandler(object):
 
 
 class MailArchiveRecord(object):
+    __slots__ = ("content_hash", "folder", "msgid", "flags", "mtime", "_attrs")
     delimiter = "::"
-    def __init__(self, string=None, content_hash=None, msgid=None, flags="", mtime=0, folder=None):
+    attr_delimiter = ","
+    def __init__(self, string=None, content_hash=None, msgid=None, flags="", mtime=0, folder=None, attrs=None):
+        # Optional per-record metadata, stored as a trailing "key=value,..." field.
+        # Most records have none, so the dict is only created when needed.
+        self._attrs = dict(attrs) if attrs else None
+        self.content_hash = content_hash
+
         if string:
             parts = str(string).split(self.delimiter)
-            if len(parts) == 4:
-                self.folder, self.msgid, self.flags, self.mtime = parts
+            if len(parts) in (4, 5):
+                self.folder, self.msgid, self.flags, self.mtime = parts[:4]
+                self.folder = sys.intern(self.folder)
                 self.mtime = float(self.mtime)
+                if len(parts) == 5:
+                    for item in parts[4].split(self.attr_delimiter):
+                        if item:
+                            k, _, v = item.partition("=")
+                            self.attrs[k] = v
             else:
                 log.critical("invalid record data: %r -> %r", string, parts)
-                raise
+                raise ValueError("invalid record data: %r" % (string,))
         else:
-            self.content_hash = content_hash
             self.msgid = msgid
             self.flags = flags
             self.mtime = float(mtime)
-            self.folder = folder
-    
+            self.folder = sys.intern(folder) if folder else folder
+
     def __str__(self):
-        return self.delimiter.join( (self.folder, self.msgid, self.flags, repr(self.mtime)) )
-    
+        fields = [self.folder, self.msgid, self.flags, repr(self.mtime)]
+        if self._attrs:
+            fields.append(self.attr_delimiter.join("%s=%s" % item for item in sorted(self._attrs.items())))
+        return self.delimiter.join(fields)
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = {}
+        return self._attrs
+
+    @property
+    def pack_offset(self):
+        '''Offset of the message in its folder's pack, or None for a plain Maildir file.'''
+        offset = self._attrs.get("pack") if self._attrs else None
+        return int(offset) if offset is not None else None
+
+    @property
+    def size(self):
+        '''Uncompressed size of the message in bytes, or None for records that predate it.'''
+        size = self._attrs.get("size") if self._attrs else None
+        return int(size) if size is not None else None
+
+    @size.setter
+    def size(self, value):
+        self.attrs["size"] = str(int(value))
+
+    @property
+    def route(self):
+        '''Cached routing inputs (year, kind), or None if absent or from other routing rules.'''
+        attrs = self._attrs
+        if not attrs or attrs.get("rules") != str(ROUTING_RULES):
+            return None
+        year = attrs.get("year")
+        return (int(year) if year else None, attrs.get("kind", ""))
+
+    @route.setter
+    def route(self, value):
+        year, kind = value
+        attrs = self.attrs
+        attrs["rules"] = str(ROUTING_RULES)
+        attrs["kind"] = kind or ""
+        if year is None:
+            attrs.pop("year", None)
+        else:
+            attrs["year"] = str(year)
+
     def merge_flags(self, newflags):
         self.flags = "".join( sorted( set(self.flags).union(set(newflags)) ) )
     
@@ -55,21 +152,156 @@ class MailArchiveRecord(object):
         return ( (self.mtime > msg.mtime) or (not set(msg.flags).issubset(set(self.flags))) )
 
 
+class RecordTable(object):
+    '''
+    A compact struct-of-arrays view of every record for bulk scans: a 64-bit hash of
+    each msgid, its store key packed into one buffer, and an interned folder ID.
+    Lookups by msgid return candidate keys; callers confirm against the store, so
+    hash collisions only cost an extra lookup.
+    '''
+    def __init__(self):
+        self.folder_names = []
+        self.folder_ids = {}
+        self.hashes = array("q")
+        self.folders = array("I")
+        self.keys = bytearray()
+        self.offsets = array("Q", [0])
+        self.sorted = True
+        # Records added after the table was sorted, until the next sort.
+        self.extra = {}
+    
+    def __len__(self):
+        return len(self.hashes) + len(self.extra)
+    
+    def folder_id(self, folder):
+        fid = self.folder_ids.get(folder)
+        if fid is None:
+            fid = self.folder_ids[folder] = len(self.folder_names)
+            self.folder_names.append(folder)
+        return fid
+    
+    def add(self, key, msgid, folder):
+        '''Add a record to a table that is already in use.'''
+        self.extra.setdefault(msgid, []).append((key, folder))
+    
+    def append(self, key, msgid, folder):
+        self.hashes.append(hash(msgid))
+        self.folders.append(self.folder_id(folder))
+        self.keys += key.encode("utf-8")
+        self.offsets.append(len(self.keys))
+        self.sorted = False
+    
+    def _sort(self):
+        '''Reorder all columns by msgid hash so lookups can bisect.'''
+        order = sorted(range(len(self.hashes)), key=self.hashes.__getitem__)
+        keys = bytearray()
+        offsets = array("Q", [0])
+        for i in order:
+            keys += self.keys[self.offsets[i]:self.offsets[i + 1]]
+            offsets.append(len(keys))
+        self.hashes = array("q", (self.hashes[i] for i in order))
+        self.folders = array("I", (self.folders[i] for i in order))
+        self.keys, self.offsets = keys, offsets
+        self.sorted = True
+    
+    def key(self, row):
+        return self.keys[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+    
+    def folder(self, row):
+        return self.folder_names[self.folders[row]]
+    
+    def candidates(self, msgid):
+        '''(key, folder) for every record whose msgid hash matches.'''
+        if not self.sorted:
+            self._sort()
+        h = hash(msgid)
+        row = bisect_left(self.hashes, h)
+        while row < len(self.hashes) and self.hashes[row] == h:
+            yield self.key(row), self.folder(row)
+            row += 1
+        for candidate in self.extra.get(msgid, ()):
+            yield candidate
+    
+    def __contains__(self, msgid):
+        for candidate in self.candidates(msgid):
+            return True
+        return False
+    
+    @classmethod
+    def from_rows(cls, rows):
+        table = cls()
+        for key, folder, msgid, value in rows:
+            table.append(key, msgid, folder)
+        table._sort()
+        return table
+
+
 class MailArchive(object):
     maildir = None
     store = None
+    compression = None
+    search_index = None
+    hash_algorithm = LEGACY
+    previous_hash = None
+    shared = None
     
-    def __init__(self, path, create=True, lazy=False, fs_layout=False):
+    def __init__(self, path, create=True, lazy=False, fs_layout=False, compression=None, search=None, index_bodies=False, hash_algorithm=None, shared=None, durability="strict", group_size=1000, store=None):
+        if compression and compression not in CODECS:
+            raise ValueError("unknown compression codec: %r" % (compression,))
+        self.compression = compression
+        
+        # When message files are synced relative to their records (see durability.Durability).
+        self.durability = Durability(durability, group_size=group_size)
+        self.pending = {}
+        
         self.maildir = Maildir(path, create=create, lazy=lazy, xattr=True, fs_layout=fs_layout)
         self.folders = {folder: self.maildir.get_folder(folder) for folder in self.maildir.list_folders()}
         
-        storepath = os.path.join(path, "archive.db")
-        self.store = kvs(storepath)
+        # Importers share this lock; fsck and other maintenance take it exclusively.
+        self.lock = ArchiveLock(os.path.join(path, "archive.lock"))
+        
+        # Archive-wide settings that must outlive a single run, like the key hash algorithm.
+        metapath = os.path.join(path, "archive-meta.db")
+        enable_wal(metapath)
+        self.meta = kvs(metapath)
+        
+        # The record store; its backend is chosen when the archive is created (see stores).
+        self.store = open_store(path, self._setup_store(store))
+        self._setup_hash(hash_algorithm)
+        
+        # Single-instance storage shared with other archives on this filesystem; remembered once set.
+        shared = shared or self._get_meta("shared")
+        if shared:
+            self._set_meta("shared", shared)
+            self.shared = SharedStore(shared)
+        
+        # Records by folder, so a scoped fsck can skip the rest of the store.
+        self.folder_index = FolderIndex(os.path.join(path, "archive-folders.db"))
+        
+        # Directory listings reused across runs while folders are unchanged.
+        self.listings = ListingCache(os.path.join(path, "archive-listings.db"))
+        
+        # Cold folders rolled into pack files, keyed by folder name.
+        self.packs = Pack.find(path)
+        
+        # The search index is kept up to date once it exists; search=False ignores it.
+        searchpath = os.path.join(path, "archive-search.db")
+        if search or (search is None and os.path.exists(searchpath)):
+            self.search_index = SearchIndex(searchpath, bodies=index_bodies)
+        
+        # Finish any fsck repairs that were interrupted.
+        self.journal = RepairJournal(os.path.join(path, "archive-repair.journal"))
+        if self.journal.exists():
+            self.replay_repairs()
         
     def __getitem__(self, msg):
-        key = msg.content_hash
+        key = self._find_key(msg)
+        if key in self.pending:
+            # Held back for the group commit; a copy, so changes go back through _rekey.
+            record, path = self.pending[key]
+            return MailArchiveRecord(str(record), content_hash=key)
         value = self.store[key]
-        return MailArchiveRecord(value)
+        return MailArchiveRecord(value, content_hash=key)
         
     def __contains__(self, msg):
         try:
@@ -78,89 +310,1112 @@ class MailArchive(object):
         except KeyError:
             return False
     
+    def _get_meta(self, key, default=None):
+        try:
+            return self.meta[key]
+        except KeyError:
+            return default
+    
+    def _set_meta(self, key, value):
+        '''
+        Set a setting (None clears it) as one upsert, and only if it changed, so archives
+        opened side by side never see it missing or race on an insert.
+        '''
+        if self._get_meta(key) == value:
+            return
+        with self.meta as transaction:
+            if value is None:
+                transaction.delete(key)
+            else:
+                transaction.set(key, value)
+    
+    def _setup_store(self, backend):
+        '''The archive's store backend; archives that predate the setting use SQLite.'''
+        recorded = self._get_meta("store")
+        if not recorded:
+            existing = os.path.exists(os.path.join(self.maildir.path, BACKENDS["sqlite"][0]))
+            recorded = "sqlite" if existing else (backend or "sqlite")
+            if recorded not in BACKENDS:
+                raise ValueError("unknown store backend: %r" % (recorded,))
+            self._set_meta("store", recorded)
+        
+        if backend and backend != recorded:
+            raise ValueError("archive uses the %s store; convert it with convert_store()" % (recorded,))
+        return recorded
+    
+    @exclusive
+    def convert_store(self, backend, batch_size=10000):
+        '''Copy every record into a store with another backend and switch the archive to it.'''
+        current = self._get_meta("store") or "sqlite"
+        if backend == current:
+            return 0
+        
+        log.warning("* Converting the record store from %s to %s", current, backend)
+        store = open_store(self.maildir.path, backend)
+        copied = copy_store(self.store, store, batch_size)
+        if len(store) != len(self.store):
+            raise RuntimeError("store conversion copied %d of %d records" % (len(store), len(self.store)))
+        
+        if hasattr(self.store, "close"):
+            self.store.close()
+        self.store = store
+        self._set_meta("store", backend)
+        log.warning("* Copied %d records; the old %s file can be removed", copied, BACKENDS[current][0])
+        return copied
+    
+    def _setup_hash(self, algorithm):
+        '''
+        Load the archive's key algorithm, or switch to a new one.  Switching starts a migration:
+        until migrate_hash() has re-keyed every record, lookups try both algorithms.
+        '''
+        if algorithm and algorithm not in ALGORITHMS:
+            raise ValueError("unknown hash algorithm: %r" % (algorithm,))
+        
+        recorded = self._get_meta("hash")
+        if not recorded:
+            # Archives that predate this setting are keyed with maildir_lite's digest.
+            recorded = LEGACY if len(self.store) else (algorithm or LEGACY)
+            self._set_meta("hash", recorded)
+        
+        self.hash_algorithm = recorded
+        self.previous_hash = self._get_meta("hash.previous")
+        
+        if algorithm and algorithm != recorded:
+            log.warning("* Switching archive keys from %s to %s", recorded, algorithm)
+            self._set_meta("hash.position", None)
+            if self.previous_hash != algorithm:
+                self._set_meta("hash.previous", recorded)
+                self.previous_hash = recorded
+            else:
+                # Switching back mid-migration: the old keys are the target again.
+                self._set_meta("hash.previous", None)
+                self.previous_hash = None
+            self._set_meta("hash", algorithm)
+            self.hash_algorithm = algorithm
+    
+    def key_for(self, msg, algorithm=None):
+        '''The index key for a message under the given (default: the archive's) algorithm.'''
+        algorithm = algorithm or self.hash_algorithm
+        if isinstance(msg, SourceMessage):
+            # Sources hash their own bytes (streamed or memory-mapped) without copies.
+            return msg.key(algorithm)
+        if algorithm == LEGACY:
+            return msg.content_hash
+        
+        # One import asks for the same key several times (lookup, add, details), so the
+        # digests are cached on the message like maildir_lite caches content_hash.
+        keys = getattr(msg, "_archive_keys", None)
+        if keys is None:
+            keys = {}
+            try:
+                msg._archive_keys = keys
+            except AttributeError:
+                pass
+        key = keys.get(algorithm)
+        if key is None:
+            key = keys[algorithm] = content_key(algorithm, msg.content)
+        return key
+    
+    def _known(self, key):
+        return key in self.pending or key in self.store
+    
+    def _find_key(self, msg):
+        '''The key a message is stored under, consulting the old algorithm during a migration.'''
+        key = self.key_for(msg)
+        if self._known(key):
+            return key
+        if self.previous_hash:
+            old_key = self.key_for(msg, self.previous_hash)
+            if self._known(old_key):
+                return old_key
+        raise KeyError(key)
+    
+    def _rekey(self, record, key, transaction=None):
+        '''
+        Store an updated record under key, dropping the key it was read under if different.
+        One upsert in one transaction (the caller's, if given), so a concurrent importer
+        never finds the key missing and adds a second copy.
+        '''
+        if record.content_hash in self.pending:
+            # Not committed yet: its file is synced with the group before the record is written.
+            self._rekey_pending(record, key)
+        elif transaction is None:
+            retry_busy(self._rekey_transaction, record, key)
+        else:
+            self._write_rekey(transaction, record, key)
+        if key != record.content_hash:
+            if self.search_index is not None:
+                self.search_index.rekey(record.content_hash, key)
+            self.folder_index.remove(record.content_hash)
+            self.folder_index.set(key, record.folder)
+            self._reshare(record, key)
+        record.content_hash = key
+    
+    def _rekey_pending(self, record, key):
+        _, path = self.pending.pop(record.content_hash)
+        # Merging flags renames the file; the group has to sync it under its new name.
+        renamed = os.path.join(os.path.dirname(path), "%s:2,%s" % (record.msgid, record.flags))
+        if renamed != path and os.path.exists(renamed):
+            path = renamed
+            self.durability.touch(path)
+        self.pending[key] = (MailArchiveRecord(str(record), content_hash=key), path)
+    
+    def _rekey_transaction(self, record, key):
+        with self.store as transaction:
+            self._write_rekey(transaction, record, key)
+    
+    def _write_rekey(self, transaction, record, key):
+        if key != record.content_hash:
+            transaction.delete(record.content_hash)
+        transaction.set(key, str(record))
+    
+    def _record_path(self, record):
+        folder = self.folders[record.folder]
+        return folder._path_for_message(folder.get_message(record.msgid, load_content=False))
+    
+    def _share(self, key, path):
+        '''Put an archived file in the shared store (or count our reference to its copy there).'''
+        if self.shared is not None:
+            self.shared.publish(key, self.maildir.path, path)
+    
+    def _unshare(self, key):
+        if self.shared is not None:
+            self.shared.release(key, self.maildir.path)
+    
+    def _reshare(self, record, key):
+        '''Move a record's shared reference from its old key to key.'''
+        if self.shared is not None:
+            self._unshare(record.content_hash)
+            if record.pack_offset is None:
+                self._share(key, self._record_path(record))
+    
+    @exclusive
+    def migrate_hash(self, budget=None, batch_size=1000):
+        '''
+        Re-key records made with the previous hash algorithm, a batch per transaction.
+        Keys are paged in order from the folder index.  With a budget in seconds it stops
+        after the batch that exceeds it; the next call carries on from the key it reached.
+        Returns the number of records migrated.
+        '''
+        if not self.previous_hash:
+            return 0
+        
+        log.warning("* Migrating archive keys from %s to %s", self.previous_hash, self.hash_algorithm)
+        deadline = time.time() + budget if budget else None
+        migrated = 0
+        finished = True
+        
+        self._check_folder_index()
+        position = self._get_meta("hash.position") or ""
+        batch = []
+        while True:
+            keys = self.folder_index.keys_after(position, batch_size)
+            if not keys:
+                break
+            position = keys[-1]
+            batch.extend(key for key in keys if algorithm_of(key) != self.hash_algorithm)
+            if len(batch) >= batch_size:
+                migrated += self._migrate_batch(batch)
+                batch = []
+                if deadline and time.time() > deadline:
+                    finished = False
+                    break
+        if batch:
+            migrated += self._migrate_batch(batch)
+        self.folder_index.flush()
+        self._set_meta("hash.position", None if finished else position)
+        
+        if finished:
+            log.warning("* Key migration to %s complete.", self.hash_algorithm)
+            self._set_meta("hash.previous", None)
+            self.previous_hash = None
+        
+        return migrated
+    
+    def _migrate_batch(self, keys):
+        migrated = 0
+        with self.store as transaction:
+            for key in keys:
+                record = MailArchiveRecord(transaction[key], content_hash=key)
+                try:
+                    content = self.read_content(record)
+                except (KeyError, OSError):
+                    # Left for fsck to clean up.
+                    log.debug("cannot read %s for migration", key)
+                    continue
+                
+                new_key = content_key(self.hash_algorithm, content)
+                if not new_key in transaction:
+                    transaction[new_key] = str(record)
+                    self.folder_index.set(new_key, record.folder)
+                transaction.delete(key)
+                self.folder_index.remove(key)
+                if self.search_index is not None:
+                    self.search_index.rekey(key, new_key)
+                self._reshare(record, new_key)
+                migrated += 1
+        return migrated
+    
+    def flush(self):
+        '''
+        Commit records held back by group or none durability: sync the group's files, then
+        their directories, then write the records in one transaction.
+        '''
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.durability.sync_group()
+        
+        with self.store as transaction:
+            for key, (record, path) in pending.items():
+                if key in transaction:
+                    # Another importer committed the same message first; fold ours into theirs.
+                    existing = MailArchiveRecord(transaction[key], content_hash=key)
+                    if existing.msgid != record.msgid:
+                        os.remove(path)
+                        self._merge_properties(existing, record.flags, record.mtime)
+                        transaction.set(key, str(existing))
+                        self.folder_index.set(key, existing.folder)
+                        if self.search_index is not None:
+                            # Re-indexed from the surviving copy by the next fsck.
+                            self.search_index.remove(key)
+                    continue
+                transaction.set(key, str(record))
+        log.debug("committed %d records", len(pending))
+    
+    def _commit_record(self, record, path):
+        '''Write a new record once its file is durable, or hold it for the group commit.'''
+        if self.durability.grouped:
+            self.pending[record.content_hash] = (record, path)
+            self.durability.touch(path)
+            if self.durability.due(len(self.pending)):
+                self.flush()
+        else:
+            self.durability.sync(path)
+            retry_busy(self.store.__setitem__, record.content_hash, str(record))
+    
+    def close(self):
+        '''Flush any batched index writes.'''
+        self.flush()
+        self.listings.close()
+        self.folder_index.close()
+        if self.shared is not None:
+            self.shared.close()
+        if self.search_index is not None:
+            self.search_index.close()
+            self.search_index = None
+    
+    def search(self, query=None, sender=None, subject=None, since=None, until=None, limit=None):
+        '''
+        Find archived messages by header (and, if indexed, body) text and date range.
+        Yields (folder, msgid, content_hash) tuples straight from the search index.
+        '''
+        if self.search_index is None:
+            raise RuntimeError("no search index; open the archive with search=True to build one")
+        return self.search_index.search(query=query, sender=sender, subject=subject, since=since, until=until, limit=limit)
+    
+    def _inflate(self, msg):
+        '''Replace a loaded archive message's content with its uncompressed bytes.'''
+        content = getattr(msg, "content", None)
+        if content and not isinstance(content, str) and sniff(content):
+            msg.content = decompress(content)
+        return msg
+    
+    def _listed_message(self, listed, record):
+        '''
+        A record's file as a content-less message (flags and mtime), found through the
+        folder's listing snapshot; listed caches the snapshots by folder for one pass.
+        '''
+        if record.folder not in listed:
+            folder = self.folders[record.folder]
+            listed[record.folder] = (folder.path, dict(self.listings.files(folder)))
+        path, names = listed[record.folder]
+        name = names[record.msgid]
+        mtime = os.stat(os.path.join(path, name)).st_mtime
+        return SourceMessage(record.msgid, None, flags=maildir_flags(os.path.basename(name)), mtime=mtime)
+    
+    def _read_file(self, msgid, path):
+        '''An archived message read straight from its file, its flags from the name.'''
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            content = f.read()
+        return SourceMessage(msgid, content, flags=maildir_flags(os.path.basename(path)), mtime=st.st_mtime)
+    
+    def get_message(self, record, load_content=True):
+        '''Fetch the archived message for a record, decompressing its content if needed.'''
+        if record.pack_offset is not None:
+            return self.packs[record.folder].get_message(record.msgid, record.pack_offset)
+        
+        folder = self.folders[record.folder]
+        msg = folder.get_message(record.msgid, load_content=load_content)
+        if load_content:
+            self._inflate(msg)
+        return msg
+    
+    def folder_year(self, foldername):
+        '''The year of a dated archive folder (e.g. /Archive/2008/Sent), or None.'''
+        relative = foldername[len(self.maildir.name):].strip("/")
+        year = relative.split("/", 1)[0]
+        return int(year) if year.isdigit() else None
+    
+    def iter_rows(self, keys=None):
+        '''
+        Stream (key, folder, msgid, value) straight from the store, or for just the given
+        keys.  Only the fields bulk scans filter on are split out; build a MailArchiveRecord
+        from value when needed.
+        '''
+        delimiter = MailArchiveRecord.delimiter
+        for key in (self.store if keys is None else keys):
+            if key is None:
+                continue
+            try:
+                value = self.store[key]
+            except KeyError:
+                continue
+            folder, msgid, _ = value.split(delimiter, 2)
+            yield key, folder, msgid, value
+    
+    def iter_records(self, folders=None, since=None, until=None):
+        '''
+        Stream records from the index, optionally limited to folders (and their subfolders)
+        and to an inclusive range of folder years.
+        '''
+        for key, folder, msgid, value in self.iter_rows():
+            if self._in_scope(folder, folders, since, until):
+                yield MailArchiveRecord(value, content_hash=key)
+    
+    def _in_scope(self, foldername, folders=None, since=None, until=None):
+        '''Whether a folder is one of folders (or beneath one) and within the inclusive year range.'''
+        if folders and not any(foldername == f or foldername.startswith(f + "/") for f in folders):
+            return False
+        if since is not None or until is not None:
+            year = self.folder_year(foldername)
+            if year is None: return False
+            if since is not None and year < since: return False
+            if until is not None and year > until: return False
+        return True
+    
+    def _key_prefixes(self, hash_prefix):
+        '''Store key prefixes for a digest prefix, under each algorithm keys may currently use.'''
+        return [make_key(algorithm, hash_prefix.lower()) for algorithm in (self.hash_algorithm, self.previous_hash) if algorithm]
+    
+    def _check_folder_index(self):
+        '''Rebuild the folder index from the store if the two disagree on the record count.'''
+        if len(self.folder_index) != len(self.store):
+            log.warning("* Rebuilding the folder index.")
+            self.folder_index.rebuild((key, folder) for key, folder, msgid, value in self.iter_rows())
+    
+    def _scoped_keys(self, folders=None, since=None, until=None, hash_prefix=None):
+        '''Keys of the records in the given folders, years and digest prefix, from the folder index.'''
+        self._check_folder_index()
+        
+        scope = None
+        if folders or since is not None or until is not None:
+            scope = [f for f in self.folder_index.folders() if self._in_scope(f, folders, since, until)]
+        return self.folder_index.keys(scope, self._key_prefixes(hash_prefix) if hash_prefix else None)
+    
+    def read_content(self, record):
+        '''Read the uncompressed bytes of an archived message with one large sequential read.'''
+        if record.pack_offset is not None:
+            return decompress(self.packs[record.folder].read(record.pack_offset))
+        
+        folder = self.folders[record.folder]
+        path = folder._path_for_message(folder.get_message(record.msgid, load_content=False))
+        with open(path, "rb", buffering=READ_BUFFER) as f:
+            data = f.read()
+        return decompress(data, codec_for_path(path))
+    
+    def _content_size(self, record):
+        '''Uncompressed size of an archived message; a stat unless it is packed or compressed.'''
+        if record.pack_offset is None:
+            folder = self.folders[record.folder]
+            path = folder._path_for_message(folder.get_message(record.msgid, load_content=False))
+            if not codec_for_path(path):
+                with open(path, "rb") as f:
+                    if not sniff(f.read(8)):
+                        return os.fstat(f.fileno()).st_size
+        return len(self.read_content(record))
+    
+    def stats(self):
+        '''
+        Message counts, byte totals and flag counts per folder and per year, plus
+        archive totals, computed from the index alone in one streaming pass.
+        Records without a stored size are counted under "unsized".
+        '''
+        def bucket():
+            return {"messages": 0, "bytes": 0, "unsized": 0, "flags": {}}
+        
+        def tally(entry, record):
+            entry["messages"] += 1
+            if record.size is None:
+                entry["unsized"] += 1
+            else:
+                entry["bytes"] += record.size
+            for flag in record.flags:
+                entry["flags"][flag] = entry["flags"].get(flag, 0) + 1
+        
+        folders = {}
+        years = {}
+        total = bucket()
+        for key, folder, msgid, value in self.iter_rows():
+            record = MailArchiveRecord(value, content_hash=key)
+            if not folder in folders:
+                folders[folder] = bucket()
+            tally(folders[folder], record)
+            
+            year = self.folder_year(folder)
+            if year is not None:
+                if not year in years:
+                    years[year] = bucket()
+                tally(years[year], record)
+            
+            tally(total, record)
+        
+        return {"folders": folders, "years": years, "total": total}
+    
+    def export(self, path, folders=None, since=None, until=None, compress=None, workers=0):
+        '''Export messages to an mbox file (see export.export_mbox).'''
+        return export_mbox(self, path, folders=folders, since=since, until=until, compress=compress, workers=workers)
+    
     def _folder_for_message(self, msg):
         '''Determine the folder to add the message to.'''
+        return self._folder(self._folder_name(msg.flags, *self._route(msg)))
+    
+    def _route(self, msg):
+        '''
+        The inputs to routing that come from the message itself: its year and its kind
+        ("sent", "notes", "todo" or ""), or (None, None) for drafts and trash, which
+        ignore both.  These are cached in the record so fsck needn't parse the headers.
+        '''
+        # Check for major flags.
+        if "D" in msg.flags or "T" in msg.flags:
+            return None, None
+        
+        # Then tell the kind of message (like sent mail or Apple Mail IMAP headers).
+        kind = ""
+        headers = msg.headers
+        if headers:
+            if headers["X-Uniform-Type-Identifier"] == "com.apple.mail-note":
+                kind = "notes"
+            
+            elif headers["X-Uniform-Type-Identifier"] == "com.apple.mail-todo":
+                kind = "todo"
+            
+            elif not (headers['Delivered-To'] or headers['Received']):
+                # Sent or received?
+                kind = "sent"
+        
+        return msg.date.year, kind
+    
+    def _folder_name(self, flags, year, kind):
+        '''The archive folder name for a message with these flags and routing inputs.'''
         # Start with the archive folder.
         foldername = self.maildir.name
         
         # Check for major flags.
-        if "D" in msg.flags:
+        if "D" in flags:
             # Draft
             foldername += "/Drafts"
-        elif "T" in msg.flags:
+        elif "T" in flags:
             # Trash
             foldername += "/Trash"
         else:
-            # Start the general case by suffixing the year of the message.
-            d = msg.date
-            foldername += "/%04d" % (d.year,)
-            
-            # Then suffix a folder based on the kind of message (like sent mail or Apple Mail IMAP headers).
-            headers = msg.headers
-            if headers:
-                if headers["X-Uniform-Type-Identifier"] == "com.apple.mail-note":
-                    foldername += "/Notes"
-                
-                elif headers["X-Uniform-Type-Identifier"] == "com.apple.mail-todo":
-                    foldername += "/Apple Mail To Do"
-                
-                elif not (headers['Delivered-To'] or headers['Received']):
-                    # Sent or received?
-                    foldername += "/Sent"
+            # Start the general case by suffixing the year of the message,
+            # then a folder based on the kind of message.
+            foldername += "/%04d" % (year,)
+            foldername += KIND_FOLDERS[kind or ""]
         
-        # Create and cache the folder if it doesn't exist.
+        return foldername
+    
+    def _folder(self, foldername):
+        '''The named archive folder, created and cached if it doesn't exist.'''
         if not foldername in self.folders:
-            folder = self.maildir.create_folder(foldername)
+            try:
+                folder = self.maildir.create_folder(foldername)
+            except OSError:
+                # Another archiver created it first.
+                folder = self.maildir.get_folder(foldername)
             self.folders[foldername] = folder
         
         return self.folders[foldername]
     
     def add_message(self, msg):
-        folder = self._folder_for_message(msg)
+        route = self._route(msg)
+        folder = self._folder(self._folder_name(msg.flags, *route))
+        
+        # The hash is always taken over the uncompressed content so dedup is unaffected.
+        content_hash = self.key_for(msg)
+        msgid = None
+        
+        # Mid-migration the message may still be known under its old key.
+        if self.previous_hash and self._known(self.key_for(msg, self.previous_hash)):
+            return self.update_message(msg)
         
         # Add the message.  We need to add to the folder first to get the final message ID.
         try:
-            msgid = folder.add_message(msg)
-            record = MailArchiveRecord(content_hash=msg.content_hash, mtime=msg.mtime, msgid=msgid, flags=msg.flags, folder=folder.name)
-            self.store[msg.content_hash] = str(record)
+            # Another archive may already hold it; then it is just a link.
+            linked = False
+            if self.shared is not None and content_hash in self.shared:
+                msgid = maildir_name()
+                path = os.path.join(folder.path, "cur", "%s:2,%s" % (msgid, msg.flags))
+                linked = self.shared.link(content_hash, self.maildir.path, path)
+            
+            if linked:
+                pass
+            elif self.compression:
+                content = msg.content
+                msg.content = compress(content, self.compression)
+                try:
+                    msgid = folder.add_message(msg)
+                finally:
+                    msg.content = content
+                archived = folder.get_message(msgid, load_content=False)
+                mark_codec(folder._path_for_message(archived), self.compression)
+            else:
+                msgid = folder.add_message(msg)
+            
+            record = MailArchiveRecord(content_hash=content_hash, mtime=msg.mtime, msgid=msgid, flags=msg.flags, folder=folder.name)
+            record.size = len(msg.content)
+            record.route = route
+            if not linked:
+                path = self._record_path(record)
+            self._commit_record(record, path)
+            self.folder_index.set(content_hash, folder.name)
+            if self.search_index is not None:
+                self.search_index.add(content_hash, folder.name, msgid, msg)
+            if not linked:
+                self._share(content_hash, path)
             return ADDED
             
         except KeyError:
             # Raised by the KV store if the sum already exists.
             # Clean up and then call update instead.
-            if msgid in folder: folder.remove(msgid)
+            if msgid and msgid in folder: folder.remove(msgid)
             return self.update_message(msg)
             
-    def update_message(self, msg):
+    def add_streamed(self, msg):
+        '''
+        Add a StreamedMessage in one pass: the source is read in chunks that are hashed and
+        written to the folder's tmp/ together, then the file is renamed into cur/ or, if its
+        key turns out to be known, discarded and the existing record updated instead.
+        '''
+        msg.date  # Fills in a missing mtime from the headers.
+        route = self._route(msg)
+        folder = self._folder(self._folder_name(msg.flags, *route))
+        
+        # Mid-migration the message may still be known under its old key; hash both at once.
+        algorithms = [self.hash_algorithm]
+        if self.previous_hash:
+            algorithms.append(self.previous_hash)
+        
+        name = maildir_name()
+        tmp = os.path.join(folder.path, "tmp", name)
+        msg.keys.update(stream_copy(msg.path, tmp, algorithms, self.compression, sync=False))
+        
+        content_hash = msg.keys[self.hash_algorithm]
+        if any(self._known(msg.keys[algorithm]) for algorithm in algorithms):
+            os.remove(tmp)
+            return self.update_message(msg)
+        
+        path = os.path.join(folder.path, "cur", "%s:2,%s" % (name, msg.flags))
+        linked = self.shared is not None and self.shared.link(content_hash, self.maildir.path, path)
+        if linked:
+            os.remove(tmp)
+        else:
+            mark_codec(tmp, self.compression)
+            os.utime(tmp, (msg.mtime, msg.mtime))
+            os.rename(tmp, path)
+        
+        record = MailArchiveRecord(content_hash=content_hash, mtime=msg.mtime, msgid=name, flags=msg.flags, folder=folder.name)
+        record.size = msg.size
+        record.route = route
+        try:
+            self._commit_record(record, path)
+        except KeyError:
+            # Another importer archived the same message since we looked.
+            os.remove(path)
+            return self.update_message(msg)
+        
+        self.folder_index.set(content_hash, folder.name)
+        if self.search_index is not None:
+            self.search_index.add(content_hash, folder.name, name, msg)
+        if not linked:
+            self._share(content_hash, path)
+        return ADDED
+    
+    def update_message(self, msg, transaction=None):
             # Fetch the existing record.
             record = self[msg]
             
             # See if there are any properties that need updating.
             if not record.should_update(msg):
                 return EXISTING
+            
+            self._merge_properties(record, msg.flags, msg.mtime)
+            
+            # Update record
+            # Keyed by the incoming message; the archived copy may be stored compressed.
+            self._rekey(record, self.key_for(msg), transaction)
+            
+            return UPDATED
+    
+    def _merge_properties(self, record, flags, mtime):
+        '''Union flags and keep the earliest mtime, on the archived message and its record.'''
+        # Packs are append-only, so flags and dates of packed messages live in the index only.
+        if record.pack_offset is not None:
+            record.merge_flags(flags)
+            record.mtime = min(record.mtime, mtime)
+            return
+        
+        # Fetch archved message
+        archive_msg = self.folders[record.folder][record.msgid]
+        
+        # Merge flags
+        archive_msg.add_flags(flags)
+        record.flags = archive_msg.flags
+        
+        # Earliest date
+        if archive_msg.mtime > mtime:
+            archive_msg.mtime = mtime
+            record.mtime = mtime
+        
+        # Update mailbox
+        self.folders[record.folder].update(record.msgid, archive_msg)
+    
+    def _sorted_keys(self, chunk_size=10000):
+        '''Every key in sorted order, paged from the folder index rather than held at once.'''
+        self._check_folder_index()
+        position = ""
+        while True:
+            keys = self.folder_index.keys_after(position, chunk_size)
+            if not keys:
+                return
+            for key in keys:
+                yield key
+            position = keys[-1]
+    
+    def _write_file(self, folder, msgid, flags, mtime, data):
+        '''Write raw message bytes straight into a folder's cur/, preserving the msgid; the caller syncs it.'''
+        path = os.path.join(folder.path, "cur", "%s:2,%s" % (msgid, flags))
+        tmp = os.path.join(folder.path, "tmp", msgid)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        mark_codec(tmp, sniff(data))
+        os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, path)
+        return path
+    
+    def _import_file(self, other, record, folder, mode):
+        '''Bring one of another archive's messages into folder by link, copy or move; returns its new path.'''
+        if record.pack_offset is not None:
+            data = other.packs[record.folder].read(record.pack_offset)
+            return self._write_file(folder, record.msgid, record.flags, record.mtime, data)
+        
+        source = other.folders[record.folder]
+        src = source._path_for_message(source.get_message(record.msgid, load_content=False))
+        dst = os.path.join(folder.path, "cur", os.path.basename(src))
+        
+        if mode == "move":
+            try:
+                os.rename(src, dst)
+                return dst
+            except OSError as e:
+                if e.errno != errno.EXDEV: raise
+        elif mode == "link":
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK): raise
+        
+        # Different filesystems (or asked to): copy, keeping the mtime and codec xattr.
+        tmp = os.path.join(folder.path, "tmp", os.path.basename(src))
+        shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+        if mode == "move":
+            os.remove(src)
+        return dst
+    
+    def merge(self, other, mode="link", batch_size=1000):
+        '''
+        Merge another archive (built elsewhere, e.g. by one node of a sharded import) into
+        this one.  Both indexes are streamed once in sorted key order: records only in other
+        are added and their files linked, copied or moved (mode) into the matching folder
+        here; records in both get the usual flag union and earliest mtime.  Records whose
+        file has gone are skipped and counted as missing.  Returns a dict of counts.
+        '''
+        if mode not in ("link", "copy", "move"):
+            raise ValueError("unknown merge mode: %r" % (mode,))
+        if other.hash_algorithm != self.hash_algorithm or other.previous_hash or self.previous_hash:
+            raise ValueError("archives must use the same hash algorithm with no migration in progress")
+        
+        counts = {"added": 0, "updated": 0, "existing": 0, "missing": 0}
+        log.warning("* Merging %s into %s", other.maildir.path, self.maildir.path)
+        self.flush()
+        other.flush()
+        
+        with self.lock.exclusive(), (other.lock.exclusive() if mode == "move" else other.lock.shared()):
+            ours = self._sorted_keys()
+            mine = next(ours, None)
+            theirs = other._sorted_keys()
+            
+            while True:
+                batch = list(itertools.islice(theirs, batch_size))
+                if not batch:
+                    break
+                moved = []
+                paths = []
+                with self.store as transaction:
+                    for key in batch:
+                        while mine is not None and mine < key:
+                            mine = next(ours, None)
+                        
+                        try:
+                            incoming = MailArchiveRecord(other.store[key], content_hash=key)
+                        except KeyError:
+                            # Removed since the folder index listed it.
+                            continue
+                        
+                        # Known here: the same message, so only its properties can differ.
+                        if mine == key:
+                            record = MailArchiveRecord(transaction[key], content_hash=key)
+                            if record.should_update(incoming):
+                                self._merge_properties(record, incoming.flags, incoming.mtime)
+                                transaction.set(key, str(record))
+                                counts["updated"] += 1
+                            else:
+                                counts["existing"] += 1
+                            continue
+                        
+                        # New here: bring the file over into the same folder under this archive.
+                        folder = self._folder(self.maildir.name + incoming.folder[len(other.maildir.name):])
+                        try:
+                            path = self._import_file(other, incoming, folder, mode)
+                        except (KeyError, OSError) as e:
+                            # A stale record in the other archive; its fsck will drop it.
+                            log.warning("! skipping %s: cannot read %s/%s: %s", key, incoming.folder, incoming.msgid, e)
+                            counts["missing"] += 1
+                            continue
+                        
+                        record = MailArchiveRecord(content_hash=key, mtime=incoming.mtime, msgid=incoming.msgid,
+                                                   flags=incoming.flags, folder=folder.name, attrs=incoming.attrs)
+                        record.attrs.pop("pack", None)
+                        transaction.set(key, str(record))
+                        paths.append(path)
+                        self.folder_index.set(key, folder.name)
+                        self._share(key, path)
+                        if self.search_index is not None:
+                            self.search_index.add(key, folder.name, record.msgid, self.get_message(record))
+                        if mode == "move":
+                            moved.append(key)
+                        counts["added"] += 1
+                    
+                    # The batch's files and directory entries go to disk before its records.
+                    self.durability.sync_paths(paths)
                 
-            # Fetch archved message
-            archive_msg = self.folders[record.folder][record.msgid]
+                # The other archive only forgets moved messages once they are recorded here.
+                if moved:
+                    with other.store as transaction:
+                        for key in moved:
+                            transaction.delete(key)
+                            other.folder_index.remove(key)
+            
+            if self.search_index is not None:
+                self.search_index.flush()
+            self.folder_index.flush()
+            other.folder_index.flush()
+        
+        log.warning("* Merged: %(added)d added, %(updated)d updated, %(existing)d already present, %(missing)d missing", counts)
+        return counts
             
-            # Merge flags
-            archive_msg.add_flags(msg.flags)
-            record.flags = archive_msg.flags
+    def _records_by_msgid(self, foldername):
+        '''Map msgids to records for every record in the given folder.'''
+        records = {}
+        for key, folder, msgid, value in self.iter_rows():
+            if folder == foldername:
+                records[msgid] = MailArchiveRecord(value, content_hash=key)
+        return records
+    
+    @exclusive
+    def pack_folder(self, foldername):
+        '''
+        Roll a cold folder into an append-only pack file and remove the message files.
+        Records are pointed at their pack entries; untracked files are left in place.
+        '''
+        folder = self.folders[foldername]
+        pack = self.packs.get(foldername) or Pack(self.maildir.path, foldername)
+        records = self._records_by_msgid(foldername)
+        
+        log.warning("* Packing %s", foldername)
+        
+        packed = []
+        with pack.open_for_append() as f:
+            for msgid in sorted(folder.keys()):
+                record = records.get(msgid)
+                if record is None:
+                    log.info("not packing untracked message %s", msgid)
+                    continue
                 
-            # Earliest date
-            if archive_msg.mtime > msg.mtime:
-                archive_msg.mtime = msg.mtime
-                record.mtime = msg.mtime
+                # Keep the file bytes as they are; compressed messages stay compressed.
+                msg = folder.get_message(msgid, load_content=True)
+                record.attrs["pack"] = str(pack.append(f, msgid, msg.content, record.flags, record.mtime))
+                packed.append(record)
+            
+            f.flush()
+            os.fsync(f.fileno())
+        
+        # Only once the data is durable do we publish the index, repoint records and drop the files.
+        pack.save_index()
+        self.durability.sync_paths(directories=[os.path.dirname(pack.path)])
+        self.packs[foldername] = pack
+        
+        with self.store as transaction:
+            for record in packed:
+                transaction.set(record.content_hash, str(record))
+        
+        for record in packed:
+            if record.msgid in folder: folder.remove(record.msgid)
+            self._unshare(record.content_hash)
+        
+        log.warning("* Packed %d messages from %s", len(packed), foldername)
+        return len(packed)
+    
+    @exclusive
+    def unpack_folder(self, foldername):
+        '''Restore a packed folder to ordinary Maildir files and remove its pack.'''
+        pack = self.packs[foldername]
+        records = self._records_by_msgid(foldername)
+        
+        folder = self._folder(foldername)
+        
+        log.warning("* Unpacking %s", foldername)
+        
+        unpacked = []
+        paths = []
+        for msgid in sorted(pack.keys()):
+            offset, length, flags, mtime = pack.entries[msgid]
+            record = records.get(msgid)
+            if record is not None:
+                flags, mtime = record.flags, record.mtime
+            
+            # Write straight into cur/ with the standard info suffix so the msgid is preserved.
+            paths.append(self._write_file(folder, msgid, flags, mtime, pack.read(offset)))
+            
+            if record is not None:
+                record.attrs.pop("pack", None)
+                unpacked.append(record)
+        
+        self.durability.sync_paths(paths)
+        with self.store as transaction:
+            for record in unpacked:
+                transaction.set(record.content_hash, str(record))
+        
+        pack.remove()
+        del self.packs[foldername]
+        
+        log.warning("* Unpacked %d messages into %s", len(pack), foldername)
+        return len(pack)
+    
+    def _apply_repair(self, action, transaction):
+        '''Apply one planned fsck repair.  Safe to repeat if a previous attempt was cut short.'''
+        folder = self.folders.get(action["folder"]) or self.maildir.get_folder(action["folder"])
+        msgid = action["msgid"]
+        
+        if action["op"] == "remove":
+            if msgid in folder: folder.remove(msgid)
+        
+        elif action["op"] == "merge":
+            if msgid in folder:
+                msg = self._inflate(folder.get_message(msgid, load_content=True))
+                if msg in self:
+                    self.update_message(msg, transaction)
+                    folder.remove(msgid)
+        
+        elif action["op"] == "place":
+            to = action["to"]
+            if to:
+                target = self._folder(to)
+                if msgid in folder:
+                    folder.move_message(msgid, target)
+            
+            # The plan's copy of the record may be stale: an earlier merge can have updated
+            # its flags and mtime since.  Only the placement (and routing cache) is ours.
+            planned = MailArchiveRecord(action["record"], content_hash=action["key"])
+            try:
+                record = MailArchiveRecord(transaction[action["key"]], content_hash=action["key"])
+            except KeyError:
+                # A record for an untracked file; nothing else has written it.
+                record = planned
+            else:
+                if record.msgid != planned.msgid:
+                    log.debug("not placing %s: its record now names %s", msgid, record.msgid)
+                    return
+                record.folder = planned.folder
+                if planned.route is not None:
+                    record.route = planned.route
+            
+            transaction.set(action["key"], str(record))
+            self.folder_index.set(action["key"], record.folder)
+            if self.search_index is not None:
+                self.search_index.move(action["key"], record.folder)
+    
+    def _apply_repairs(self, batches, done=()):
+        '''Apply journaled (number, actions) batches in turn, committing the store after each.'''
+        for i, batch in batches:
+            if i in done:
+                continue
+            log.debug("applying repair batch %d (%s, %d actions)", i + 1, batch[0]["folder"], len(batch))
+            with self.store as transaction:
+                for action in batch:
+                    self._apply_repair(action, transaction)
                 
-            # Update mailbox
-            self.folders[record.folder].update(record.msgid, archive_msg)
+                # Messages moved between folders are durable in their new place before their records.
+                moved = set(action["to"] for action in batch if action["op"] == "place" and action["to"])
+                self.durability.sync_paths(directories=[os.path.join(self.folders[to].path, sub)
+                                                        for to in sorted(moved) for sub in ("cur", "new")])
+            self.folder_index.flush()
+            self.journal.mark_done(i)
+        self.journal.remove()
+    
+    @exclusive
+    def replay_repairs(self):
+        '''Finish the repairs of an fsck that was interrupted while applying them.'''
+        # Checked again under the lock: the fsck that wrote it may have finished meanwhile.
+        if not self.journal.exists():
+            return
+        done = self.journal.done()
+        log.warning("* Resuming interrupted repairs (%d batches already applied).", len(done))
+        self._apply_repairs(self.journal.iter_batches(), done)
+    
+    def _verify_one(self, record):
+        '''Re-hash one archived message; returns (bytes read, matching key) or (0, None) if unreadable.'''
+        try:
+            content = self.read_content(record)
+        except (KeyError, OSError) as e:
+            log.debug("cannot read %s for verification: %s", record.content_hash, e)
+            return 0, None
+        return len(content), content_key(algorithm_of(record.content_hash), content)
+    
+    def _quarantine(self, record):
+        '''Move a corrupt message file out of the archive folders and drop its record.'''
+        if record.pack_offset is None:
+            folder = self.folders[record.folder]
+            path = folder._path_for_message(folder.get_message(record.msgid, load_content=False))
+            os.rename(path, os.path.join(self.maildir.path, "archive.quarantine." + os.path.basename(path)))
+        retry_busy(self.store.__delitem__, record.content_hash)
+        if self.search_index is not None:
+            self.search_index.remove(record.content_hash)
+        self.folder_index.remove(record.content_hash)
+        self._unshare(record.content_hash)
+    
+    def verify(self, sample=1.0, seconds=None, max_bytes=None, workers=4, quarantine=False, chunk_size=10000):
+        '''
+        Check that archived files still hash to their keys.  Keys are visited in sorted order
+        from where the last run stopped (kept in the metadata store), so successive runs
+        rotate through the whole archive; each key is checked with probability sample, and
+        the run ends when the time or byte budget is spent.  Hashing runs in a thread pool.
+        Returns a list of (key, folder, msgid, problem).
+        '''
+        position = start = self._get_meta("verify.position") or ""
+        deadline = time.time() + seconds if seconds else None
+        
+        log.warning("* Verifying archive contents (sample %.0f%%) from %r", sample * 100, position[:16])
+        
+        # Runs alongside importers, but not while fsck reorganises folders.
+        with self.lock.shared():
+            problems = self._verify(position, start, deadline, max_bytes, sample, workers, quarantine, chunk_size)
+        if quarantine:
+            self.folder_index.flush()
+        return problems
+    
+    def _verify(self, position, start, deadline, max_bytes, sample, workers, quarantine, chunk_size):
+        read = 0
+        checked = 0
+        problems = []
+        wrapped = False
+        
+        # The folder index keeps the keys sorted, so each chunk is one range read.  It is
+        # paged as it is: importers run alongside, so it is not rebuilt here, and keys
+        # that have gone from the store are skipped below.
+        if not len(self.folder_index) and len(self.store):
+            log.warning("! The folder index is empty; run fsck to build it before verifying.")
+        
+        while True:
+            # The next chunk of keys after the position.
+            keys = self.folder_index.keys_after(position, chunk_size, start if wrapped else None)
+            if not keys:
+                if wrapped or not start:
+                    break
+                # A full cycle is done; start over from the beginning.
+                position = ""
+                wrapped = True
+                continue
             
-            # Update record
-            del self.store[archive_msg.content_hash]
-            self.store[archive_msg.content_hash] = str(record)
+            chosen = [key for key in keys if sample >= 1 or random.random() < sample]
+            records = []
+            for key in chosen:
+                try:
+                    records.append(MailArchiveRecord(self.store[key], content_hash=key))
+                except KeyError:
+                    continue
             
-            return UPDATED
+            stopped = False
+            for record, (size, actual) in read_ahead(self._verify_one, records, workers):
+                read += size
+                checked += 1
+                position = record.content_hash
+                
+                if actual is None:
+                    problems.append( (record.content_hash, record.folder, record.msgid, "unreadable") )
+                elif actual != record.content_hash:
+                    log.warning("! %s/%s does not match its key %s", record.folder, record.msgid, record.content_hash)
+                    problems.append( (record.content_hash, record.folder, record.msgid, "content mismatch") )
+                    if quarantine:
+                        self._quarantine(record)
+                
+                if (deadline and time.time() > deadline) or (max_bytes and read >= max_bytes):
+                    stopped = True
+                    break
             
-    def check(self, repair=True):
+            if not stopped:
+                position = keys[-1]
+            self._set_meta("verify.position", position)
+            if stopped:
+                break
+        
+        log.warning("* Verify complete. %d checked; %d bytes read; %d problems.", checked, read, len(problems))
+        return problems
+    
+    def _tracked_record(self, records, msgid, transaction):
+        '''The record for a msgid found through a RecordTable, confirmed against the store.'''
+        for key, folder in records.candidates(msgid):
+            try:
+                record = MailArchiveRecord(transaction[key], content_hash=key)
+            except KeyError:
+                continue
+            if record.msgid == msgid:
+                return record
+        return None
+    
+    @exclusive
+    def check(self, repair=True, throttle=None, folders=None, since=None, until=None, hash_prefix=None):
+        '''
+        Reconcile the index with the maildir.  throttle, a throttle.Throttle, paces both
+        passes so fsck can run beside a live mail server.
+
+        folders, since/until (folder years) and hash_prefix (of the digest) limit the check
+        to part of the archive.  Records in scope come from the folder index, so the record
+        pass costs what the scope holds.  The untracked pass only lists folders in scope,
+        but untracked files have no key until read, so a hash prefix alone still reads
+        every folder; pair it with folders or years to bound that.
+
+        Records cache the year and kind of their message (see _route()), so known
+        messages are placed without reading them; those without a cache, or with one from
+        older routing rules, are parsed once and the cache filled in.
+        '''
+        scoped = bool(folders or since is not None or until is not None or hash_prefix)
+        scoped_folders = bool(folders or since is not None or until is not None)
+        prefixes = tuple(self._key_prefixes(hash_prefix)) if hash_prefix else None
         errors = []
         
         deletes = 0
@@ -184,25 +1439,35 @@ class MailArchive(object):
         
         with CancelHandler() as handler:
             idx = 0
-            count = len(self.store)
+            if scoped:
+                keys = self._scoped_keys(folders, since, until, hash_prefix)
+                count = len(keys)
+                log.warning("* Checking %d records in scope.", count)
+            else:
+                keys = None
+                count = len(self.store)
             interval = max(1, int(count/100))
             
             log.debug("KVS has %d records.", count)
             
-            # Iterate over all the keys in the KV store.
+            # Listing snapshots of the folders records point into, loaded as they are needed.
+            listed = {}
+            
+            # Iterate over all the keys in the KV store (or the scope).
             with self.store as transaction:
                 with Output(name="Records (check)", total=count) as output:
-                    for key in transaction:
+                    for key in (transaction if keys is None else keys):
                         # Check to see if ^C has been hit.
                         if handler.STOP: break
                     
                         # Recreate the record object from the store's value.
                         try:
                             record_str = transaction[key]
-                            record = MailArchiveRecord(record_str)
+                            record = MailArchiveRecord(record_str, content_hash=key)
                         except KeyError:
                             # "None" is a valid key to the KVS, but not to us.
-                            if key is None:
+                            # Scoped keys come from the folder index, which can lag the store.
+                            if key is None or keys is not None:
                                 continue
                             else:
                                 raise
@@ -218,21 +1483,30 @@ class MailArchive(object):
                             errors.append( (record.content_hash, "empty msgid") )
                             delete = True
                 
+                        # Packed messages only need their pack entry; flags and dates are index-only.
+                        if record.pack_offset is not None:
+                            pack = self.packs.get(record.folder)
+                            if pack is None or record.msgid not in pack:
+                                log.debug("missing pack entry %s in folder %s", record.msgid, record.folder)
+                                errors.append( (record.msgid, "missing pack entry") )
+                                delete = True
+                        
                         # Load the message content.
-                        try:
-                            msg = self.folders[record.folder].get_message(record.msgid, load_content=False)
-                
-                        except (KeyError, TypeError):
-                            log.debug("invalid msgid %s in folder %s", record.msgid, record.folder)
-                            errors.append( (record.msgid, "invalid msgid") )
-                            delete = True
+                        else:
+                            try:
+                                msg = self._listed_message(listed, record)
+                            
+                            except (KeyError, TypeError, FileNotFoundError):
+                                log.debug("invalid msgid %s in folder %s", record.msgid, record.folder)
+                                errors.append( (record.msgid, "invalid msgid") )
+                                delete = True
                         
                         if msg:
                             # Verify that all the flags on the message are in the record.
                             if not set(msg.flags).issubset(set(record.flags)):
                                 log.debug("invalid flags: %s", record.msgid)
                                 errors.append( (record.msgid, "invalid flags") )
-                                record.merge_flags(record.flags)
+                                record.merge_flags(msg.flags)
                                 update = True
                                         
                             # Verify that the date is later than the earliest known date.
@@ -242,11 +1516,27 @@ class MailArchive(object):
                                 record.mtime = msg.mtime
                                 update = True
                 
+                        # Backfill sizes for records archived before they were kept.
+                        if not delete and record.size is None:
+                            try:
+                                record.size = self._content_size(record)
+                                update = True
+                            except (KeyError, OSError):
+                                pass
+                        
+                        # Backfill the search index for records archived before it existed.
+                        if msg and not delete and self.search_index is not None and not key in self.search_index:
+                            self.search_index.add(key, record.folder, record.msgid, self.get_message(record))
+                        
                         # Fix anything that needs fixing.
                         if repair:
                             if delete:
                                 log.debug("- deleting %r", key)
                                 transaction.delete(key)
+                                if self.search_index is not None:
+                                    self.search_index.remove(key)
+                                self.folder_index.remove(key)
+                                self._unshare(key)
                                 deletes += 1
                             elif update:
                                 log.debug("= updating %r", key)
@@ -258,95 +1548,189 @@ class MailArchive(object):
                         elif update: mark = 'U'
                         else: mark = '.'
                         output.increment(mark)
+                        
+                        if throttle is not None:
+                            throttle.message()
             
             # Now check the maildirs.
             if handler.STOP == False:
                 
-                # Cache all the records by their message ID.
+                # Cache every record's msgid, key and folder in a compact table.
                 log.debug("Caching index records...")
-                records = {}
-                for key in self.store.keys():
-                    value = self.store[key]
-                    record = MailArchiveRecord(value)
-                    records[record.msgid] = record
-                
-                # Iterate over all the folders in the maildir.
-                log.warning("* Checking for untracked messages.")
-                with self.store as transaction:
-                    for foldername in sorted(self.maildir.list_folders()):
-                        # Check to see if ^C has been hit.
-                        if handler.STOP: break
-                
-                        folder = self.maildir.get_folder(foldername)
+                records = RecordTable.from_rows(self.iter_rows(keys))
                 
-                        keys = folder.keys()
-                        count = len(keys)
-                        interval = max(1, int(count/100))
+                # Packed entries without a record can't be rehashed cheaply; report them.
+                # Under a hash prefix the table is partial, so every entry would look untracked.
+                for foldername, pack in sorted(self.packs.items()):
+                    if prefixes or not self._in_scope(foldername, folders, since, until):
+                        continue
+                    for msgid in pack.keys():
+                        if not msgid in records:
+                            log.debug("untracked pack entry %s in %s", msgid, foldername)
+                            errors.append( (msgid, "pack entry is not in the archive") )
                 
-                        # Iterate over all the messages in the folder.
-                        log.debug("iterating through %s (%d)", folder.name, count)
-                        with Output(name=folder.name + " (check)", total=count) as output:
-                            for msgid in sorted(keys):
-                                # Check to see if ^C has been hit.
-                                if handler.STOP: break
-                                
-                                # Print a status message every now and again.
-                                output.increment('.')
-                                
-                                msg = folder.get_message(msgid, load_content=True)
+                # Iterate over all the folders in the maildir, planning repairs as we go.
+                # Each folder's plan is journaled as soon as it is made, not held in memory.
+                log.warning("* Checking for untracked messages.")
+                actions = []
+                planned = set()
+                backfill = []
+                for foldername in sorted(self.maildir.list_folders()):
+                    # Check to see if ^C has been hit.
+                    if handler.STOP: break
+            
+                    folder = self.maildir.get_folder(foldername)
+                    if scoped_folders and not self._in_scope(folder.name, folders, since, until):
+                        continue
+            
+                    # File names (flags included) come from the listing snapshot, so a static
+                    # folder is neither listed again nor looked up through maildir_lite.
+                    files = self.listings.files(folder)
+                    count = len(files)
+                    interval = max(1, int(count/100))
+            
+                    # Iterate over all the messages in the folder.
+                    log.debug("iterating through %s (%d)", folder.name, count)
+                    with Output(name=folder.name + " (check)", total=count) as output:
+                        for msgid, name in files:
+                            # Check to see if ^C has been hit.
+                            if handler.STOP: break
+                            
+                            # Print a status message every now and again.
+                            output.increment('.')
+                            
+                            # Known messages whose record caches its routing inputs are placed
+                            # from the index alone, without opening the file.
+                            record = self._tracked_record(records, msgid, self.store)
+                            route = record.route if record is not None else None
+                            if route is not None:
+                                flags = maildir_flags(name)
+                                if route[0] is None and not ("D" in flags or "T" in flags):
+                                    # Routed as a draft or trash, but no longer flagged as one.
+                                    route = None
+                            
+                            if route is not None:
+                                if throttle is not None:
+                                    throttle.message()
+                                if prefixes and not record.content_hash.startswith(prefixes):
+                                    continue
+                                added = False
+                                routed = False
+                            
+                            else:
+                                path = os.path.join(folder.path, name)
+                                try:
+                                    msg = self._inflate(self._read_file(msgid, path))
+                                except FileNotFoundError:
+                                    log.debug("%s vanished during the check", path)
+                                    continue
+                                content_hash = self.key_for(msg)
+                                if throttle is not None:
+                                    throttle.message(len(msg.content))
+                                if prefixes and not content_hash.startswith(prefixes):
+                                    continue
                                 
                                 # Check to see if this message is known in the database or not.
-                                if not msgid in records:
+                                if record is None and scoped:
+                                    # The table only covers the scope; the record may name a folder outside it.
+                                    try:
+                                        found = self[msg]
+                                        if found.msgid == msgid:
+                                            record = found
+                                    except KeyError:
+                                        pass
+                                if record is None:
                                     errors.append( (msgid, "message in maildir is not in the archive") )
-                                    if repair:
-                                        if len(msg.content) == 0:
-                                            # Delete
-                                            log.debug("- delete empty message file")
-                                            if msgid in folder: folder.remove(msgid)
-                                            deletes += 1
-                                            continue
-                                    
-                                        elif msg.content_hash in transaction:
-                                            # Merge and delete
-                                            log.debug("= merge duplicate %s", msgid)
-                                            self.update_message(msg)
-                                            if msgid in folder: folder.remove(msgid)
-                                            deletes += 1
-                                            updates += 1
-                                            record = MailArchiveRecord(transaction[msg.content_hash])
-                                    
-                                        else:
-                                            # Add record
-                                            log.debug("+ record for %s", folder._path_for_message(msg))
-                                            record = MailArchiveRecord(content_hash=msg.content_hash, mtime=msg.mtime, msgid=msg.msgid, flags=msg.flags, folder=folder.name)
-                                            transaction[msg.content_hash] = str(record)
-                                            records[msg.content_hash] = record
-                                            adds += 1
-                                    else:
+                                    if not repair:
                                         log.debug("unknown msgid: %s", msgid)
+                                        continue
+                                    
+                                    if len(msg.content) == 0:
+                                        # Delete
+                                        log.debug("- delete empty message file")
+                                        actions.append({"op": "remove", "folder": folder.name, "msgid": msgid})
+                                        deletes += 1
+                                        continue
+                                
+                                    elif content_hash in planned or msg in self:
+                                        # Merge and delete
+                                        log.debug("= merge duplicate %s", msgid)
+                                        actions.append({"op": "merge", "folder": folder.name, "msgid": msgid})
+                                        deletes += 1
+                                        updates += 1
+                                        continue
                                 
+                                    else:
+                                        # Add record
+                                        log.debug("+ record for %s", path)
+                                        record = MailArchiveRecord(content_hash=content_hash, mtime=msg.mtime, msgid=msg.msgid, flags=msg.flags, folder=folder.name)
+                                        record.size = len(msg.content)
+                                        records.add(content_hash, msg.msgid, folder.name)
+                                        planned.add(content_hash)
+                                        adds += 1
+                                        added = True
                                 else:
-                                    record = records[msgid]
+                                    added = False
+                                
+                                # Parse the headers once and cache the result for later checks.
+                                flags = msg.flags
+                                route = self._route(msg)
+                                routed = record.route != route
+                                record.route = route
+                        
+                            # Get the cannonical folder for this message.
+                            msg_folder = self._folder(self._folder_name(flags, *route))
+                            move_to = None
+                                                
+                            # Check to see if it's in that folder.
+                            if folder.name != msg_folder.name:
+                                log.debug("~ %s: %s -> %s" % (msgid, folder.name, msg_folder.name))
+                                move_to = msg_folder.name
+                        
+                            # Check the record's folder against (a possibly new) reality.
+                            elif record.folder != msg_folder.name:
+                                log.debug("~ updating record folder from %s to %s" % (record.folder, msg_folder.name))
                             
-                                # Get the cannonical folder for this message.
-                                msg_folder = self._folder_for_message(msg)
-                                                    
-                                # Check to see if it's in that folder.
-                                if folder.name != msg_folder.name:
-                                    log.debug("~ %s: %s -> %s" % (msgid, folder.name, msg_folder.name))
-                                    if repair:
-                                        folder.move_message(msgid, msg_folder)
-                                        # msg_folder.add_message(msg)
-                                        # if msgid in folder: folder.remove(msgid)
-                                        record.folder = msg_folder.name
-                                        transaction[msg.content_hash] = str(record)
+                            elif routed and not added:
+                                # Placed right; only the record's routing cache is new.
+                                if repair:
+                                    backfill.append((record.content_hash, str(record)))
+                                continue
+                            
+                            elif not added:
+                                continue
                             
-                                # Check the record's folder against (a possibly new) reality.
-                                if record.folder != msg_folder.name:
-                                    log.debug("~ updating record folder from %s to %s" % (record.folder, msg_folder.name))
-                                    if repair:
-                                        record.folder = msg_folder.name
-                                        transaction[msg.content_hash] = str(record)
+                            if repair:
+                                record.folder = msg_folder.name
+                                actions.append({"op": "place", "folder": folder.name, "msgid": msgid, "to": move_to,
+                                                "key": record.content_hash, "record": str(record)})
+                    
+                    if actions:
+                        if self.journal.writer is None:
+                            self.journal.start()
+                        for batch in plan_batches(actions):
+                            self.journal.add(batch)
+                        actions = []
+                    
+                    # Write the folder's routing backfill in one transaction.
+                    if backfill:
+                        with self.store as transaction:
+                            for key, value in backfill:
+                                transaction.set(key, value)
+                        backfill = []
+                
+                # Publish the whole plan, then apply it a batch at a time.
+                if self.journal.writer is not None:
+                    if handler.STOP:
+                        self.journal.abandon()
+                    else:
+                        self.journal.finish()
+                        self._apply_repairs(self.journal.iter_batches())
+                
+                if self.search_index is not None:
+                    self.search_index.flush()
+            
+            self.folder_index.flush()
                     
         log.warning("* Check complete. %d processed; %d added; %d updated; %d deleted.", count, adds, updates, deletes)
         
@@ -0,0 +1,91 @@
+import logging
+import lzma
+import os
+import zlib
+
+log = logging.getLogger(__name__)
+
+# Extended attribute used to mark a message file as compressed.
+XATTR = "user.mailarchive.codec"
+
+LZMA_MAGIC = b"\xfd7zXZ\x00"
+
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def compress(data, codec):
+    '''Compress raw message bytes with the named codec.'''
+    if not codec:
+        return data
+    if isinstance(data, str):
+        data = data.encode("utf-8", "surrogateescape")
+    return CODECS[codec][0](data)
+
+
+def sniff(data):
+    '''Guess the codec of a blob from its magic bytes; None if it looks like plain mail.'''
+    if data.startswith(LZMA_MAGIC):
+        return "lzma"
+    # A zlib stream starts with CMF 0x78 and a check byte making the header a multiple of 31.
+    if len(data) > 2 and data[0] == 0x78 and ((data[0] << 8) | data[1]) % 31 == 0:
+        return "zlib"
+    return None
+
+
+def decompress(data, codec=None):
+    '''
+    Return the uncompressed bytes of a message.  Without a codec the data is sniffed,
+    and anything that fails to decompress is assumed to be an uncompressed message.
+    '''
+    if isinstance(data, str):
+        return data
+
+    guessed = codec is None
+    if guessed:
+        codec = sniff(data)
+    if not codec:
+        return data
+
+    try:
+        return CODECS[codec][1](data)
+    except (zlib.error, lzma.LZMAError):
+        if guessed:
+            return data
+        raise
+
+
+def mark(path, codec):
+    '''Record the codec on the file; silently skipped on filesystems without xattrs.'''
+    try:
+        if codec:
+            os.setxattr(path, XATTR, codec.encode("ascii"))
+        else:
+            os.removexattr(path, XATTR)
+    except (OSError, AttributeError):
+        pass
+
+
+def codec_for_path(path):
+    try:
+        return os.getxattr(path, XATTR).decode("ascii")
+    except (OSError, AttributeError):
+        return None
+
+
+def read_file(path):
+    '''Read a message file, transparently decompressing it.'''
+    with open(path, "rb") as f:
+        data = f.read()
+    return decompress(data, codec_for_path(path))
+
+
+def compressor(codec):
+    '''An incremental compressor (compress()/flush()) producing the same stream as compress().'''
+    if codec == "zlib":
+        return zlib.compressobj(9)
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=6)
+    raise ValueError("unknown compression codec: %r" % (codec,))
@@ -0,0 +1,57 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+MAILDIR_SUBDIRS = frozenset(("cur", "new", "tmp"))
+
+
+def _scan(path):
+    '''
+    List a directory once: whether it is a Maildir (has cur/, new/ and tmp/) and which
+    of its entries are other directories.  Symlinks are not followed.
+    '''
+    subdirs = []
+    names = set()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        names.add(entry.name)
+                        subdirs.append(entry)
+                except OSError:
+                    continue
+    except OSError as e:
+        log.debug("cannot scan %s: %s", path, e)
+        return False, []
+    return MAILDIR_SUBDIRS.issubset(names), [entry for entry in subdirs if entry.name not in MAILDIR_SUBDIRS]
+
+
+def discover_maildirs(root, fs_layout=False, workers=16):
+    '''
+    Yield the paths of every Maildir folder below root as soon as each is found, scanning
+    directories on a thread pool (most of a walk over NFS is waiting on the server).
+
+    Maildir++ folders are the dot-directories directly under root; with fs_layout folders
+    are plain subdirectories, nested to any depth.  Discovery order is not sorted.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan, root): (root, True)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, is_root = pending.pop(future)
+                is_maildir, subdirs = future.result()
+
+                if is_maildir and not is_root:
+                    yield path
+
+                # Maildir++ is flat: only the root's dot-directories are folders.
+                if not fs_layout and not is_root:
+                    continue
+                for entry in subdirs:
+                    if entry.name.startswith(".") != (not fs_layout):
+                        continue
+                    pending[pool.submit(_scan, entry.path)] = (entry.path, False)
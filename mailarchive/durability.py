@@ -0,0 +1,102 @@
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+MODES = ("strict", "group", "none")
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability(object):
+    '''
+    How hard the archive works to survive a crash, and in what order.  The invariant in
+    every mode except none: a record is never committed to the index before the message
+    file it points at, and the directory entry naming that file, are on disk.  A crash can
+    therefore leave a file without a record (fsck adopts it) but never a record without
+    its file.
+
+    strict  After each message: fsync the file, fsync its directory, then commit the
+            record.  Three syncs per message; nothing acknowledged is ever lost.
+    group   Messages are written and their records held back.  When the group fills (or
+            ages out, or the archive is flushed or closed): fsync every touched file, then
+            each touched directory once, then commit all the records in one transaction.
+            A crash loses at most the records of the open group.
+    none    No fsyncs at all, records still committed a group at a time.  For bulk
+            rebuilds where the source can simply be imported again; after a crash the
+            index may name files the kernel never wrote, so run fsck.
+
+    Operations that write files and commit their records in batches of their own (merge,
+    unpack, fsck moving messages between folders) call sync_paths() for the batch just
+    before committing it, in both strict and group modes.
+    '''
+    def __init__(self, mode="strict", group_size=1000, group_seconds=5.0):
+        if mode not in MODES:
+            raise ValueError("unknown durability mode: %r" % (mode,))
+        self.mode = mode
+        self.group_size = group_size
+        self.group_seconds = group_seconds
+        self.files = []
+        self.started = None
+
+    @property
+    def grouped(self):
+        '''Whether records are held back and committed a group at a time.'''
+        return self.mode != "strict"
+
+    def sync(self, path):
+        '''strict: make one file and its directory entry durable before its record is written.'''
+        if self.mode == "strict":
+            fsync_path(path)
+            fsync_path(os.path.dirname(path))
+
+    def touch(self, path):
+        '''group/none: remember a written file until the group is synced.'''
+        if self.started is None:
+            self.started = time.monotonic()
+        if self.mode == "group":
+            self.files.append(path)
+
+    def due(self, pending):
+        if self.started is None:
+            return False
+        return pending >= self.group_size or time.monotonic() - self.started >= self.group_seconds
+
+    def sync_group(self):
+        '''Fsync every touched file, then every touched directory once.  Call before committing.'''
+        files, self.files, self.started = self.files, [], None
+        self.sync_paths(files)
+
+    def sync_paths(self, files=(), directories=()):
+        '''Fsync files, then their directories and any others given, each once (not in none mode).'''
+        if self.mode == "none":
+            return
+        synced = 0
+        seen = set()
+        ordered = []
+        for path in files:
+            try:
+                fsync_path(path)
+            except FileNotFoundError:
+                # Moved or removed since; whoever did that owns its durability.
+                continue
+            synced += 1
+            directory = os.path.dirname(path)
+            if directory not in seen:
+                seen.add(directory)
+                ordered.append(directory)
+        for directory in directories:
+            if directory not in seen:
+                seen.add(directory)
+                ordered.append(directory)
+        for directory in ordered:
+            fsync_path(directory)
+        if synced:
+            log.debug("synced %d files in %d directories", synced, len(ordered))
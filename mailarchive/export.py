@@ -0,0 +1,84 @@
+import gzip
+import logging
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# mboxrd quoting: any line starting with zero or more ">" and "From " gets one more ">".
+FROM_LINE = re.compile(rb"^(>*From )", re.MULTILINE)
+
+READ_BUFFER = 1024 * 1024
+WRITE_BUFFER = 4 * 1024 * 1024
+
+
+def mbox_entry(content, mtime):
+    '''Format one message as an mboxrd entry.'''
+    if isinstance(content, str):
+        content = content.encode("utf-8", "surrogateescape")
+
+    envelope = b"From MAILER-DAEMON " + time.asctime(time.gmtime(mtime)).encode("ascii") + b"\n"
+    body = FROM_LINE.sub(rb">\1", content)
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    return envelope + body + b"\n"
+
+
+def read_ahead(func, items, workers):
+    '''
+    Map func over items in order with a bounded window of reads in flight,
+    so at most a few messages are held in memory at once.
+    '''
+    if not workers:
+        for item in items:
+            yield item, func(item)
+        return
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for item in items:
+            window.append((item, pool.submit(func, item)))
+            if len(window) > workers * 2:
+                item, future = window.popleft()
+                yield item, future.result()
+        while window:
+            item, future = window.popleft()
+            yield item, future.result()
+
+
+def export_mbox(archive, path, folders=None, since=None, until=None, compress=None, workers=0):
+    '''
+    Stream archived messages into a single mbox file (gzip'd when compress is set or
+    the path ends with .gz) and return the number of messages written.
+    '''
+    if compress is None:
+        compress = path.endswith(".gz")
+
+    if compress:
+        out = gzip.open(path, "wb", compresslevel=6)
+    else:
+        out = open(path, "wb", buffering=WRITE_BUFFER)
+
+    def read(record):
+        try:
+            return archive.read_content(record)
+        except (KeyError, OSError) as e:
+            # A stale record; fsck will drop it.  One must not abort the whole export.
+            log.warning("! skipping %s/%s: %s", record.folder, record.msgid, e)
+            return None
+
+    count = 0
+    missing = 0
+    with out:
+        records = archive.iter_records(folders=folders, since=since, until=until)
+        for record, content in read_ahead(read, records, workers):
+            if content is None:
+                missing += 1
+                continue
+            out.write(mbox_entry(content, record.mtime))
+            count += 1
+
+    log.warning("* Exported %d messages to %s (%d missing)", count, path, missing)
+    return count
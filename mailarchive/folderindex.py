@@ -0,0 +1,107 @@
+import logging
+import sqlite3
+
+from .locking import tune_sqlite
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    content_hash TEXT PRIMARY KEY,
+    folder TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_folder ON records (folder);
+"""
+
+
+def prefix_range(prefix):
+    '''The [low, high) key range of strings starting with prefix.'''
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class FolderIndex(object):
+    '''
+    A secondary index of the record store by folder, so a scoped fsck can fetch the keys
+    of a few folders (or a key range) without scanning every record.  Changes are queued
+    and written in batches.  It is derived data: when its row count disagrees with the
+    store's it is rebuilt from the store.
+    '''
+    batch_size = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.db = sqlite3.connect(path)
+        tune_sqlite(self.db)
+        self.db.executescript(SCHEMA)
+
+    def set(self, content_hash, folder):
+        self.pending[content_hash] = folder
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def remove(self, content_hash):
+        self.set(content_hash, None)
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        with self.db:
+            self.db.executemany("DELETE FROM records WHERE content_hash = ?",
+                                ((key,) for key, folder in pending.items() if folder is None))
+            self.db.executemany("INSERT OR REPLACE INTO records (content_hash, folder) VALUES (?, ?)",
+                                ((key, folder) for key, folder in pending.items() if folder is not None))
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def rebuild(self, rows):
+        '''Replace the index with (key, folder) rows.'''
+        self.pending = {}
+        with self.db:
+            self.db.execute("DELETE FROM records")
+            self.db.executemany("INSERT OR REPLACE INTO records (content_hash, folder) VALUES (?, ?)", rows)
+
+    def folders(self):
+        self.flush()
+        return [row[0] for row in self.db.execute("SELECT DISTINCT folder FROM records")]
+
+    def keys(self, folders=None, prefixes=None):
+        '''Sorted keys in any of folders (None: all) whose key starts with any of prefixes (None: any).'''
+        self.flush()
+        where = []
+        args = []
+        if folders is not None:
+            folders = list(folders)
+            if not folders:
+                return []
+            where.append("folder IN (%s)" % ",".join("?" * len(folders)))
+            args.extend(folders)
+        if prefixes:
+            ranges = []
+            for prefix in prefixes:
+                ranges.append("(content_hash >= ? AND content_hash < ?)")
+                args.extend(prefix_range(prefix))
+            where.append("(%s)" % " OR ".join(ranges))
+
+        query = "SELECT content_hash FROM records"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        return [row[0] for row in self.db.execute(query + " ORDER BY content_hash", args)]
+
+    def keys_after(self, after, limit, until=None):
+        '''Up to limit sorted keys greater than after (and not past until), by index range.'''
+        self.flush()
+        query = "SELECT content_hash FROM records WHERE content_hash > ?"
+        args = [after]
+        if until is not None:
+            query += " AND content_hash <= ?"
+            args.append(until)
+        args.append(limit)
+        return [row[0] for row in self.db.execute(query + " ORDER BY content_hash LIMIT ?", args)]
+
+    def close(self):
+        self.flush()
+        self.db.close()
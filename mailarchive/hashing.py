@@ -0,0 +1,50 @@
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+# The digest maildir_lite puts in Message.content_hash.  Keys made with it carry no prefix,
+# every other algorithm's keys are "<algorithm>:<hexdigest>" so a key names its own algorithm.
+LEGACY = "sha1"
+
+ALGORITHMS = {
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "blake2b": lambda: hashlib.blake2b(digest_size=20),
+}
+
+# Non-cryptographic hashes are much faster but only fit dedup-only archives.
+try:
+    import xxhash
+    ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+
+def hasher(algorithm):
+    '''Return a fresh hash object with update() and hexdigest().'''
+    try:
+        return ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("unknown hash algorithm: %r" % (algorithm,))
+
+
+def make_key(algorithm, hexdigest):
+    if algorithm == LEGACY:
+        return hexdigest
+    return "%s:%s" % (algorithm, hexdigest)
+
+
+def content_key(algorithm, content):
+    '''The archive key for a message's raw bytes.'''
+    if isinstance(content, str):
+        content = content.encode("utf-8", "surrogateescape")
+    h = hasher(algorithm)
+    h.update(content)
+    return make_key(algorithm, h.hexdigest())
+
+
+def algorithm_of(key):
+    if key and ":" in key:
+        return key.split(":", 1)[0]
+    return LEGACY
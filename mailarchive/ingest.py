@@ -0,0 +1,108 @@
+import email.parser
+import email.policy
+import itertools
+import logging
+import os
+import socket
+import time
+
+from .compression import compressor
+from .hashing import hasher, make_key
+from .sources import SourceMessage
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+# Messages at least this big are streamed rather than loaded whole.
+STREAM_THRESHOLD = 8 << 20
+
+# Headers longer than this are cut short when parsing a streamed message.
+HEAD_LIMIT = 256 << 10
+
+_counter = itertools.count()
+
+
+def maildir_name():
+    '''A new unique Maildir file name (time.MusecPpidQcount.host).'''
+    now = time.time()
+    host = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+    return "%d.M%dP%dQ%d.%s" % (now, int((now % 1) * 1000000), os.getpid(), next(_counter), host)
+
+
+def read_head(path, limit=HEAD_LIMIT, chunk_size=64 << 10):
+    '''The header block of a message file, without reading the body.'''
+    head = b""
+    with open(path, "rb") as f:
+        while len(head) < limit:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            head += chunk
+            for separator in (b"\n\n", b"\r\n\r\n"):
+                end = head.find(separator)
+                if end >= 0:
+                    return head[:end + len(separator)]
+    return head[:limit]
+
+
+def stream_copy(src, dst, algorithms, codec=None, chunk_size=CHUNK_SIZE, sync=True):
+    '''
+    Read src once in fixed-size chunks, hashing with each algorithm and, if dst is given,
+    writing (optionally compressed) to it and, with sync, fsyncing it.  Memory use is one
+    chunk however big the message is.  Returns {algorithm: key}.
+    '''
+    hashes = {algorithm: hasher(algorithm) for algorithm in algorithms}
+    out = open(dst, "xb") if dst else None
+    packer = compressor(codec) if out and codec else None
+    try:
+        with open(src, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                for h in hashes.values():
+                    h.update(chunk)
+                if out:
+                    out.write(packer.compress(chunk) if packer else chunk)
+        if out:
+            if packer:
+                out.write(packer.flush())
+            out.flush()
+            if sync:
+                os.fsync(out.fileno())
+    except:
+        if out:
+            out.close()
+            os.remove(dst)
+            out = None
+        raise
+    finally:
+        if out:
+            out.close()
+    return {algorithm: make_key(algorithm, h.hexdigest()) for algorithm, h in hashes.items()}
+
+
+class StreamedMessage(SourceMessage):
+    '''
+    A large source message that is never held in memory.  Headers come from the top of
+    the file; keys are computed by streaming it, or filled in by the archive's single-pass
+    hash-and-copy (MailArchive.add_streamed).  content is always None; use size.
+    '''
+    def __init__(self, path, msgid, flags="", mtime=None):
+        SourceMessage.__init__(self, msgid, None, flags, mtime)
+        self.path = path
+        self.size = os.stat(path).st_size
+        self.keys = {}
+
+    def key(self, algorithm):
+        if algorithm not in self.keys:
+            self.keys.update(stream_copy(self.path, None, [algorithm]))
+        return self.keys[algorithm]
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            parser = email.parser.BytesHeaderParser(policy=email.policy.compat32)
+            self._headers = parser.parsebytes(read_head(self.path))
+        return self._headers
@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def plan_batches(actions, batch_size=1000):
+    '''Group repair actions by the folder they touch and split them into batches.'''
+    ordered = sorted(actions, key=lambda action: action["folder"])
+    batches = []
+    for action in ordered:
+        if not batches or len(batches[-1]) >= batch_size or batches[-1][0]["folder"] != action["folder"]:
+            batches.append([])
+        batches[-1].append(action)
+    return batches
+
+
+class RepairJournal(object):
+    '''
+    A write-ahead log of fsck repairs.  Every planned action is on disk before any is
+    applied; a "done" line follows each batch once its store updates are committed.
+    Actions are idempotent, so after a crash the unfinished batches are simply replayed.
+    Plans are written and read back a batch at a time, so neither side holds all of one.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.batches = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _sync_dir(self):
+        fd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def start(self):
+        '''Begin a new plan.  Batches are written as they are planned and published by finish().'''
+        self.writer = open(self.path + ".tmp", "w")
+        self.writer.write(json.dumps({"version": 2}) + "\n")
+        self.batches = 0
+
+    def add(self, batch):
+        for action in batch:
+            self.writer.write(json.dumps(dict(action, batch=self.batches)) + "\n")
+        self.batches += 1
+
+    def finish(self):
+        '''Make the plan durable and publish it, before any of it is applied.  Returns the batch count.'''
+        f, self.writer = self.writer, None
+        with f:
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + ".tmp", self.path)
+        self._sync_dir()
+        return self.batches
+
+    def abandon(self):
+        '''Drop a plan that was started but will not be applied.'''
+        f, self.writer = self.writer, None
+        f.close()
+        os.remove(self.path + ".tmp")
+
+    def write(self, batches):
+        self.start()
+        for batch in batches:
+            self.add(batch)
+        return self.finish()
+
+    def done(self):
+        '''The numbers of the batches already applied.  A torn last line is ignored.'''
+        done = set()
+        with open(self.path, "r") as f:
+            f.readline()
+            for line in f:
+                if line.startswith('{"done"'):
+                    try:
+                        done.add(json.loads(line)["done"])
+                    except ValueError:
+                        break
+        return done
+
+    def iter_batches(self):
+        '''Yield (number, actions) for each batch in order, reading one batch at a time.'''
+        number = None
+        batch = []
+        with open(self.path, "r") as f:
+            f.readline()
+            for line in f:
+                if line.startswith('{"done"'):
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry["batch"] != number:
+                    if batch:
+                        yield number, batch
+                    number, batch = entry["batch"], []
+                del entry["batch"]
+                batch.append(entry)
+        if batch:
+            yield number, batch
+
+    def mark_done(self, batch):
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"done": batch}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        os.remove(self.path)
+        self._sync_dir()
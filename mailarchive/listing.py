@@ -0,0 +1,161 @@
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+from .locking import tune_sqlite
+from .schedule import maildir_key
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    path TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL,
+    checksum INTEGER NOT NULL,
+    keys BLOB NOT NULL,
+    count INTEGER
+);
+"""
+
+# A directory changed this recently might still be changing within the same mtime tick.
+SETTLE_SECONDS = 2
+
+
+def directory_stamp(path):
+    '''The mtimes of a Maildir's new/ and cur/ directories; any delivery or rename changes one.'''
+    parts = []
+    for sub in ("new", "cur"):
+        try:
+            st = os.stat(os.path.join(path, sub))
+        except OSError:
+            return None
+        parts.append("%d:%d" % (st.st_ino, st.st_mtime_ns))
+    return " ".join(parts)
+
+
+def scan_keys(path):
+    '''
+    Yield (msgid, file path, DirEntry) for a Maildir's new/ and cur/ in the order readdir
+    returns them.  Nothing is sorted or kept, so the first key arrives at once and memory
+    stays flat however big the directory.
+    '''
+    for sub in ("new", "cur"):
+        try:
+            with os.scandir(os.path.join(path, sub)) as it:
+                for entry in it:
+                    if not entry.name.startswith("."):
+                        yield maildir_key(entry.name), entry.path, entry
+        except FileNotFoundError:
+            continue
+
+
+def estimate_entries(path, sample=1000):
+    '''
+    Guess how many messages a Maildir holds without listing it: each directory's size
+    divided by the size of an entry (8 bytes plus the name, 4-byte aligned, as ext4 and
+    most others store them), with the average name taken from the first few entries.
+    '''
+    total = 0
+    for sub in ("new", "cur"):
+        directory = os.path.join(path, sub)
+        names = 0
+        length = 0
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    names += 1
+                    length += len(entry.name)
+                    if names >= sample:
+                        break
+            size = os.stat(directory).st_size
+        except OSError:
+            continue
+        if names < sample:
+            # Read it all; no need to guess.
+            total += names
+            continue
+        entry_size = (8 + length // names + 3) & ~3
+        total += max(names, size // entry_size)
+    return total
+
+
+class ListingCache(object):
+    '''
+    Persistent snapshots of Maildir listings.  A snapshot is reused while the
+    directories' mtimes are unchanged, so static folders skip the readdir and sort.
+    Each snapshot is the zlib-compressed list of file names relative to the Maildir
+    ("cur/<msgid>:2,<flags>"), sorted by msgid, with a CRC32 to catch corruption.  The
+    names carry the flags, so callers open files from the snapshot without listing.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        tune_sqlite(self.db)
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(listings)")]
+        if "count" not in columns:
+            # Snapshots from before the column have no count until they are next written.
+            with self.db:
+                self.db.execute("ALTER TABLE listings ADD COLUMN count INTEGER")
+
+    def get(self, path, stamp):
+        row = self.db.execute("SELECT stamp, checksum, keys FROM listings WHERE path = ?", (path,)).fetchone()
+        if not row or row[0] != stamp:
+            return None
+
+        data = zlib.decompress(row[2])
+        if zlib.crc32(data) != row[1]:
+            log.warning("corrupt listing snapshot for %s; relisting", path)
+            return None
+        names = data.decode("utf-8", "surrogateescape").split("\n") if data else []
+        if names and "/" not in names[0]:
+            # Snapshots from before file names were kept hold bare msgids.
+            return None
+        return names
+
+    def count(self, path):
+        '''How many keys the last snapshot of path had, valid or not; None if unknown.'''
+        row = self.db.execute("SELECT count FROM listings WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, path, stamp, names):
+        data = "\n".join(names).encode("utf-8", "surrogateescape")
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO listings (path, stamp, checksum, keys, count) VALUES (?, ?, ?, ?, ?)",
+                            (path, stamp, zlib.crc32(data), zlib.compress(data, 1), len(names)))
+
+    def files(self, maildir):
+        '''
+        Sorted (msgid, name) pairs for a Maildir (or folder), name relative to its path and
+        including the flags, from the snapshot when it is still valid.
+        '''
+        stamp = directory_stamp(maildir.path)
+        if stamp:
+            names = self.get(maildir.path, stamp)
+            if names is not None:
+                log.debug("using listing snapshot for %s (%d keys)", maildir.path, len(names))
+                return [(maildir_key(os.path.basename(name)), name) for name in names]
+
+        files = []
+        seen = set()
+        for msgid, name in sorted((msgid, os.path.relpath(path, maildir.path)) for msgid, path, entry in scan_keys(maildir.path)):
+            # A message in both new/ and cur/ is listed once, from cur/.
+            if msgid not in seen:
+                seen.add(msgid)
+                files.append((msgid, name))
+
+        # Only trust the stamp if nothing could have landed in the same mtime tick as the listing.
+        if stamp and stamp == directory_stamp(maildir.path):
+            newest = max(os.stat(os.path.join(maildir.path, sub)).st_mtime for sub in ("new", "cur"))
+            if time.time() - newest > SETTLE_SECONDS:
+                self.put(maildir.path, stamp, [name for msgid, name in files])
+        return files
+
+    def keys(self, maildir):
+        '''Sorted keys of a Maildir (or folder), from the snapshot when it is still valid.'''
+        return [msgid for msgid, name in self.files(maildir)]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,110 @@
+import errno
+import fcntl
+import logging
+import os
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+BUSY_TIMEOUT = 30.0
+
+
+def tune_sqlite(db, busy_timeout=BUSY_TIMEOUT):
+    '''Put a connection in WAL mode (readers never block the writer) with a busy timeout.'''
+    db.execute("PRAGMA busy_timeout = %d" % int(busy_timeout * 1000))
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+
+
+def enable_wal(path, busy_timeout=BUSY_TIMEOUT):
+    '''
+    Switch an SQLite file to WAL mode.  The journal mode is stored in the database, so
+    connections opened later by other libraries (like the record store) inherit it.
+    '''
+    db = sqlite3.connect(path, timeout=busy_timeout)
+    try:
+        tune_sqlite(db, busy_timeout)
+    finally:
+        db.close()
+
+
+def is_busy(error):
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+def retry_busy(func, *args, **kwargs):
+    '''
+    Call func, retrying with jittered backoff while SQLite reports the database busy.
+    Covers connections we cannot set a busy timeout on ourselves.
+    '''
+    deadline = time.time() + BUSY_TIMEOUT
+    delay = 0.005
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or time.time() > deadline:
+                raise
+            log.debug("database busy; retrying in %.3fs", delay)
+            time.sleep(delay * (1 + random.random()))
+            delay = min(delay * 2, 0.5)
+
+
+class ArchiveLock(object):
+    '''
+    Advisory lock separating writers that may run side by side from ones that may not.
+    Importers hold it shared, so several can fill one archive at once; fsck and other
+    maintenance that reorganises folders hold it exclusive.  Nested use of the same mode
+    (or shared inside exclusive) is a no-op.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.mode = None
+        self.depth = 0
+
+    @contextmanager
+    def _hold(self, mode, blocking):
+        if self.depth:
+            if self.mode == fcntl.LOCK_SH and mode == fcntl.LOCK_EX:
+                raise RuntimeError("cannot upgrade a shared archive lock to exclusive")
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+            return
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            flags = mode if blocking else mode | fcntl.LOCK_NB
+            try:
+                fcntl.flock(self.fd, flags)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    raise RuntimeError("archive is locked by another process: %s" % (self.path,))
+                raise
+            if mode == fcntl.LOCK_EX:
+                log.debug("holding exclusive archive lock")
+
+            self.mode = mode
+            self.depth = 1
+            try:
+                yield self
+            finally:
+                self.depth = 0
+                self.mode = None
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def shared(self, blocking=True):
+        return self._hold(fcntl.LOCK_SH, blocking)
+
+    def exclusive(self, blocking=True):
+        return self._hold(fcntl.LOCK_EX, blocking)
@@ -1,9 +1,15 @@
+import json
 import logging
+import sys
+import threading
 from .progress import *
 
 ADDED = "+"
 UPDATED = "^"
 EXISTING = "."
+MISSING = "?"
+
+RESULTS = {ADDED: "added", UPDATED: "updated", EXISTING: "existing", MISSING: "missing"}
 
 log = logging.getLogger(__name__)
 
@@ -133,3 +139,85 @@ class StandardOutput(object):
             
             print(self.clreol, end="")
             print("%-30s  %3d%%  %8d  %7.1fm/s  %s" % (self.name, pct, self.count, mps, eta), end=end, flush=True)
+
+class EventStream(object):
+    '''
+    A buffered, thread-safe sink for JSON-lines events.  Lines collect in memory and are
+    written in one go when the buffer fills or a background timer fires, so emitting an
+    event costs an append rather than a write.
+    '''
+    def __init__(self, path="-", buffer_size=1 << 20, interval=1.0):
+        self.owned = path != "-"
+        self.file = open(path, "a", buffering=buffer_size) if self.owned else sys.stdout
+        self.buffer_size = buffer_size
+        self.interval = interval
+        self.lines = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.timer = threading.Thread(target=self._run, name="event-flush", daemon=True)
+        self.timer.start()
+    
+    def _run(self):
+        while not self.done.wait(self.interval):
+            self.flush()
+    
+    def emit(self, event):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.lines.append(line)
+            self.size += len(line)
+            if self.size < self.buffer_size:
+                return
+            lines, self.lines, self.size = self.lines, [], 0
+            self.file.write("".join(lines))
+    
+    def flush(self):
+        with self.lock:
+            lines, self.lines, self.size = self.lines, [], 0
+            if lines:
+                self.file.write("".join(lines))
+            self.file.flush()
+    
+    def close(self):
+        self.done.set()
+        self.timer.join()
+        self.flush()
+        if self.owned:
+            self.file.close()
+
+class JSONOutput(object):
+    '''
+    Emits one JSON event per message (what happened to it, where it went, how long it
+    took) and a summary per folder to an EventStream, for audit trails and tooling.
+    '''
+    detailed = True
+    
+    def __init__(self, name="", total=0, stream=None):
+        self.name = name
+        self.total = total
+        self.stream = stream
+        self.counts = dict.fromkeys(RESULTS.values(), 0)
+        self.bytes = 0
+    
+    def __enter__(self):
+        self.started = self.last = time.monotonic()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        event = {"event": "folder", "source": self.name, "total": self.total, "bytes": self.bytes,
+                 "elapsed_us": int((time.monotonic() - self.started) * 1000000)}
+        event.update(self.counts)
+        self.stream.emit(event)
+    
+    def increment(self, mark="", msgid=None, content_hash=None, folder=None, size=None):
+        # Elapsed covers everything since the previous message: reading, hashing and writing.
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        
+        result = RESULTS.get(mark, mark)
+        if result in self.counts: self.counts[result] += 1
+        if size: self.bytes += size
+        
+        self.stream.emit({"event": "message", "source": self.name, "msgid": msgid, "content_hash": content_hash,
+                          "result": result, "folder": folder, "bytes": size, "elapsed_us": int(elapsed * 1000000)})
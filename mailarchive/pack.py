@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import re
+
+from .compression import decompress
+
+log = logging.getLogger(__name__)
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+ENTRY_MAGIC = b"MAPK"
+
+# Indexes are written with the folder first, so it can be read without the entries.
+INDEX_FOLDER = re.compile(r'\s*\{\s*"folder"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def pack_basename(foldername):
+    '''Flatten a folder name into a file name that no Maildir layout treats as a folder.'''
+    return "archive." + foldername.strip("/").replace("/", ".")
+
+
+def index_folder(index_path):
+    '''The folder a pack index belongs to, read from the head of the file.'''
+    with open(index_path, "r") as f:
+        match = INDEX_FOLDER.match(f.read(4096))
+    if match:
+        return json.loads(match.group(1))
+    with open(index_path, "r") as f:
+        return json.load(f)["folder"]
+
+
+class PackedMessage(object):
+    '''
+    A read-only stand-in for a Maildir message whose bytes live in a pack.
+    '''
+    def __init__(self, folder, msgid, content, flags="", mtime=0):
+        self.folder = folder
+        self.msgid = msgid
+        self.content = content
+        self.flags = flags
+        self.mtime = mtime
+
+
+class Pack(object):
+    '''
+    An append-only pack of messages from a single cold folder.
+
+    Each entry is a header line ("MAPK <length> <msgid>\\n") followed by the raw message
+    file bytes (compressed messages stay compressed) and a newline.  The sidecar index maps
+    msgids to their entry offset and the flags and mtime the file had when it was packed.
+    '''
+    folder = None
+    path = None
+    index_path = None
+
+    def __init__(self, root, folder):
+        self.folder = folder
+        base = os.path.join(root, pack_basename(folder))
+        self.path = base + PACK_SUFFIX
+        self.index_path = base + INDEX_SUFFIX
+        self._entries = None
+
+    @property
+    def entries(self):
+        '''msgid -> [offset, length, flags, mtime], loaded from the index on first use.'''
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r") as f:
+                    data = json.load(f)
+                self.folder = data["folder"]
+                self._entries = data["entries"]
+        return self._entries
+
+    @classmethod
+    def find(cls, root):
+        '''Every pack in an archive directory, keyed by folder name; indexes load lazily.'''
+        packs = {}
+        for name in sorted(os.listdir(root)):
+            if name.startswith("archive.") and name.endswith(INDEX_SUFFIX):
+                folder = index_folder(os.path.join(root, name))
+                packs[folder] = cls(root, folder)
+        return packs
+
+    def __contains__(self, msgid):
+        return msgid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def append(self, f, msgid, content, flags, mtime):
+        '''Append one entry to an open pack file and return its offset.'''
+        if isinstance(content, str):
+            content = content.encode("utf-8", "surrogateescape")
+
+        offset = f.tell()
+        f.write(b"%s %d %s\n" % (ENTRY_MAGIC, len(content), msgid.encode("utf-8")))
+        f.write(content)
+        f.write(b"\n")
+        self.entries[msgid] = [offset, len(content), flags, mtime]
+        return offset
+
+    def open_for_append(self):
+        f = open(self.path, "ab")
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def save_index(self):
+        '''Atomically replace the index once the pack data it describes is on disk.'''
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"folder": self.folder, "entries": self.entries}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.index_path)
+
+    def read(self, offset):
+        '''Read the raw bytes of the entry at the given offset.'''
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            header = f.readline().split(b" ", 2)
+            if len(header) != 3 or header[0] != ENTRY_MAGIC:
+                raise KeyError("no pack entry at offset %d in %s" % (offset, self.path))
+            return f.read(int(header[1]))
+
+    def get_message(self, msgid, offset=None):
+        entry_offset, length, flags, mtime = self.entries[msgid]
+        if offset is None:
+            offset = entry_offset
+        return PackedMessage(self.folder, msgid, decompress(self.read(offset)), flags, mtime)
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
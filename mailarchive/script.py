@@ -5,12 +5,26 @@ import sys                  # stdout, argv, exit
 import time                 # sleep
 import logging
 import argparse
+import functools
+import itertools
+import json
+from datetime import datetime
 
 from maildir_lite import Maildir, InvalidMaildirError
 
 from .archive import MailArchive, MailArchiveRecord
 from .progress import Progress
-from .outputs import QuietOutput, StandardOutput, VerboseOutput, ADDED, UPDATED, EXISTING
+from .outputs import QuietOutput, StandardOutput, VerboseOutput, JSONOutput, EventStream, ADDED, UPDATED, EXISTING, MISSING
+from .compression import CODECS
+from .hashing import ALGORITHMS
+from .sources import EmlxMailbox, MboxFile, SourceMessage
+from .schedule import ReadScheduler, ORDERS, maildir_flags
+from .listing import scan_keys, estimate_entries
+from .throttle import Throttle, set_ioprio
+from .ingest import StreamedMessage, STREAM_THRESHOLD
+from .discovery import discover_maildirs
+from .durability import MODES as DURABILITY_MODES
+from .stores import BACKENDS
 
 
 def clean_path(path):
@@ -19,6 +33,114 @@ def clean_path(path):
     path = os.path.realpath(path)   # Resolve symlinks and return cannonical path
     return path
 
+def iter_maildir(source, msgids, stream_threshold=None):
+    '''
+    Yield (msgid, message) from a Maildir; message is None if it vanished.  Files of at
+    least stream_threshold bytes come back as StreamedMessages instead of being loaded.
+    '''
+    for msgid in msgids:
+        try:
+            if stream_threshold:
+                msg = source.get_message(msgid, load_content=False)
+                path = source._path_for_message(msg)
+                if os.stat(path).st_size >= stream_threshold:
+                    yield msgid, StreamedMessage(path, msgid, flags=msg.flags, mtime=msg.mtime)
+                    continue
+            yield msgid, source[msgid]
+        except (KeyError, FileNotFoundError):
+            logging.error("%s: message not found" % (msgid,))
+            yield msgid, None
+
+def read_maildir_file(msgid, filepath, st, stream_threshold=None):
+    '''A Maildir message straight from its file, its flags from the name; streamed if big.'''
+    flags = maildir_flags(os.path.basename(filepath))
+    if stream_threshold and st.st_size >= stream_threshold:
+        return StreamedMessage(filepath, msgid, flags=flags, mtime=st.st_mtime)
+    with open(filepath, "rb") as f:
+        content = f.read()
+    return SourceMessage(msgid, content, flags=flags, mtime=st.st_mtime)
+
+def iter_maildir_files(path, files, stream_threshold=None):
+    '''
+    Yield (msgid, message) for (msgid, name) pairs from a listing snapshot, opening each
+    file by its recorded name so maildir_lite never has to list the directory.
+    '''
+    for msgid, name in files:
+        filepath = os.path.join(path, name)
+        try:
+            yield msgid, read_maildir_file(msgid, filepath, os.stat(filepath), stream_threshold)
+        except FileNotFoundError:
+            logging.error("%s: message not found" % (msgid,))
+            yield msgid, None
+
+def iter_maildir_stream(path, stream_threshold=None):
+    '''
+    Yield (msgid, message) for a Maildir straight from readdir, reading each file as its
+    name comes back rather than listing and sorting the directory first.
+    '''
+    for msgid, filepath, entry in scan_keys(path):
+        try:
+            yield msgid, read_maildir_file(msgid, filepath, entry.stat(), stream_threshold)
+        except FileNotFoundError:
+            logging.error("%s: message not found" % (msgid,))
+            yield msgid, None
+
+def message_size(msg):
+    if isinstance(msg, StreamedMessage):
+        return msg.size
+    return len(msg.content)
+
+def import_message(archive, msg, dry_run=False):
+    '''Add or update one message in the archive and return the result mark.'''
+    result = EXISTING
+    
+    # Big messages are hashed while they are copied, so don't read them to look them up first.
+    if isinstance(msg, StreamedMessage) and not dry_run:
+        return archive.add_streamed(msg)
+    
+    try:
+        record = archive[msg]
+        if record.should_update(msg):
+            if dry_run:
+                result = UPDATED
+            else:
+                result = archive.update_message(msg)
+    except KeyError:
+        if dry_run:
+            result = ADDED
+        else:
+            result = archive.add_message(msg)
+    return result
+
+def message_details(archive, msgid, msg):
+    '''Where an imported message ended up, for detailed (event) output.'''
+    try:
+        record = archive[msg]
+    except KeyError:
+        # A dry run adds nothing.
+        return dict(msgid=msgid, size=message_size(msg))
+    return dict(msgid=msgid, content_hash=record.content_hash, folder=record.folder, size=message_size(msg))
+
+def print_stats(stats, as_json=False):
+    if as_json:
+        json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+    
+    def line(name, entry):
+        flags = " ".join("%s:%d" % item for item in sorted(entry["flags"].items()))
+        unsized = " (%d unsized)" % entry["unsized"] if entry["unsized"] else ""
+        print("%-40s %10d %14d%s  %s" % (name, entry["messages"], entry["bytes"], unsized, flags))
+    
+    print("%-40s %10s %14s  %s" % ("folder", "messages", "bytes", "flags"))
+    for name, entry in sorted(stats["folders"].items()):
+        line(name, entry)
+    print()
+    for year, entry in sorted(stats["years"].items()):
+        line(str(year), entry)
+    print()
+    line("total", stats["total"])
+
 def main(argc, argv):
     global STOP, archive, DRY_RUN
     STOP = False
@@ -67,7 +189,102 @@ def main(argc, argv):
                             action="store_true", help="use FS layout for archive subfolders instead of Maildir++")
     parser.add_argument("-f", "--fsck",
                             action="store_true", help="verify and repair the archive's index")
-    parser.add_argument("maildirs", nargs="+")
+    parser.add_argument("-z", "--compress", default=None, choices=sorted(CODECS),
+                            help="store newly archived messages compressed with this codec")
+    parser.add_argument("--pack", action="append", default=[], metavar="FOLDER",
+                            help="roll a cold archive folder into a pack file (repeatable)")
+    parser.add_argument("--unpack", action="append", default=[], metavar="FOLDER",
+                            help="restore a packed archive folder to a normal Maildir (repeatable)")
+    parser.add_argument("--index", action="store_true",
+                            help="build and maintain the archive's header search index")
+    parser.add_argument("--index-bodies", action="store_true",
+                            help="also index plain-text message bodies (implies --index)")
+    parser.add_argument("-s", "--search", default=None, metavar="QUERY",
+                            help="search the archive's index (FTS5 query syntax) and exit")
+    parser.add_argument("--from", dest="sender", default=None,
+                            help="with --search, match the sender")
+    parser.add_argument("--subject", default=None,
+                            help="with --search, match the subject")
+    parser.add_argument("--after", default=None, metavar="YYYY-MM-DD",
+                            help="with --search, only messages dated on or after this day")
+    parser.add_argument("--before", default=None, metavar="YYYY-MM-DD",
+                            help="with --search, only messages dated before this day")
+    parser.add_argument("--export", default=None, metavar="MBOX",
+                            help="export archived messages to an mbox file (gzip'd if it ends in .gz) and exit")
+    parser.add_argument("--folder", action="append", default=[],
+                            help="limit --export or --fsck to an archive folder and its subfolders (repeatable)")
+    parser.add_argument("--since", type=int, default=None, metavar="YEAR",
+                            help="limit --export or --fsck to year folders from YEAR on")
+    parser.add_argument("--until", type=int, default=None, metavar="YEAR",
+                            help="limit --export or --fsck to year folders up to YEAR")
+    parser.add_argument("--workers", type=int, default=0,
+                            help="number of read-ahead threads for --export and hashing threads for --verify (default 4)")
+    parser.add_argument("--emlx", action="store_true",
+                            help="sources are Apple Mail trees (e.g. ~/Library/Mail/V10) instead of Maildirs")
+    parser.add_argument("--mbox", action="store_true",
+                            help="sources are mbox files instead of Maildirs (interrupted imports resume)")
+    parser.add_argument("--parse-workers", type=int, default=None, metavar="N",
+                            help="number of processes parsing .emlx files (default: one per CPU)")
+    parser.add_argument("--hash", default=None, choices=sorted(ALGORITHMS),
+                            help="content hash used to key the archive (changing it starts a key migration)")
+    parser.add_argument("--migrate-hash", type=float, default=None, metavar="SECONDS",
+                            help="re-key records to the current hash for up to SECONDS (0 for no limit)")
+    parser.add_argument("--read-order", default="name", choices=ORDERS,
+                            help="order to read source messages in: by name, inode, or physical extent (FIEMAP)")
+    parser.add_argument("--prefetch", type=int, default=64, metavar="N",
+                            help="with --read-order inode/extent, prefetch N files ahead and drop read files from the page cache")
+    parser.add_argument("--stats", action="store_true",
+                            help="print per-folder and per-year counts, sizes and flags from the index and exit")
+    parser.add_argument("--json", action="store_true",
+                            help="with --stats, print JSON")
+    parser.add_argument("--verify", action="store_true",
+                            help="re-hash archived messages against their keys, continuing where the last run stopped")
+    parser.add_argument("--sample", type=float, default=1.0, metavar="RATE",
+                            help="with --verify, fraction of messages to check (0-1)")
+    parser.add_argument("--verify-seconds", type=float, default=None, metavar="SECONDS",
+                            help="with --verify, stop after this long")
+    parser.add_argument("--verify-bytes", type=int, default=None, metavar="BYTES",
+                            help="with --verify, stop after reading this much")
+    parser.add_argument("--quarantine", action="store_true",
+                            help="with --verify, move corrupt messages aside and drop their records")
+    parser.add_argument("--max-bytes", type=int, default=None, metavar="BYTES",
+                            help="import and fsck at most this many bytes per second (read plus written)")
+    parser.add_argument("--max-messages", type=float, default=None, metavar="N",
+                            help="import and fsck at most this many messages per second")
+    parser.add_argument("--adaptive", action="store_true",
+                            help="slow down while disk latency is well above normal")
+    parser.add_argument("--nice", type=int, default=None, metavar="N",
+                            help="raise the process's CPU niceness by N")
+    parser.add_argument("--idle-io", action="store_true",
+                            help="only use the disk when nothing else wants it (Linux idle I/O class)")
+    parser.add_argument("--merge", action="append", default=[], metavar="ARCHIVE",
+                            help="merge another archive folder (e.g. from another import node) into this one")
+    parser.add_argument("--merge-mode", default="link", choices=("link", "copy", "move"),
+                            help="how --merge brings missing message files over (default: link)")
+    parser.add_argument("--events", default=None, metavar="PATH",
+                            help="write a JSON-lines event per imported message and per folder to PATH ('-' for stdout, moving all other output to stderr)")
+    parser.add_argument("--stream-threshold", type=int, default=STREAM_THRESHOLD, metavar="BYTES",
+                            help="hash and copy Maildir messages at least this big in one streaming pass (0 to disable)")
+    parser.add_argument("--shared-store", default=None, metavar="PATH",
+                            help="share message files with other archives through a store at PATH (remembered)")
+    parser.add_argument("--shared-gc", action="store_true",
+                            help="remove files in the shared store that no archive references")
+    parser.add_argument("--hash-prefix", default=None, metavar="HEX",
+                            help="with --fsck, only check messages whose digest starts with HEX")
+    parser.add_argument("--scan-workers", type=int, default=16, metavar="N",
+                            help="with --recursive, scan this many directories at once while finding subfolders")
+    parser.add_argument("--durability", default="strict", choices=DURABILITY_MODES,
+                            help="strict: sync each message before its record; group: sync and commit in groups; "
+                                 "none: no syncs, for rebuilds (default: strict)")
+    parser.add_argument("--group-size", type=int, default=1000, metavar="N",
+                            help="messages per group commit with --durability group or none")
+    parser.add_argument("--stream-listing", action="store_true",
+                            help="import Maildir messages in directory order as they are listed, with an estimated total")
+    parser.add_argument("--store", default=None, choices=sorted(BACKENDS),
+                            help="record store backend for a new archive (default: sqlite)")
+    parser.add_argument("--convert-store", default=None, choices=sorted(BACKENDS), metavar="BACKEND",
+                            help="copy the archive's records into another store backend and switch to it")
+    parser.add_argument("maildirs", nargs="*")
 
     args = parser.parse_args()
     logging.info(args)
@@ -87,17 +304,56 @@ def main(argc, argv):
         logging.debug("Output %r", Output)
         if logging.getLogger().getEffectiveLevel() != logging.DEBUG:
             logging.getLogger().setLevel(logging.INFO)
+    events = None
+    if args.events:
+        events = EventStream(args.events)
+        if args.events == "-":
+            # Keep the JSON-lines stream on stdout free of anything else: log text, fsck
+            # progress and --stats/--verify/search results all go to stderr instead.
+            for handler in logging.getLogger().handlers:
+                if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                    handler.setStream(sys.stderr)
+            sys.stdout = sys.stderr
+        Output = functools.partial(JSONOutput, stream=events)
     CHECK_ARCHIVE = args.fsck
     DRY_RUN = args.dry_run
     RECURSIVE = args.recursive
     USE_FS_LAYOUT = args.fs
+    COMPRESSION = args.compress
+    
+    # Be a good neighbour on a live server.
+    if args.nice:
+        os.nice(args.nice)
+    if args.idle_io:
+        set_ioprio("idle")
+    throttle = Throttle.from_options(args.max_bytes, args.max_messages, args.adaptive)
     
     logging.debug("Archive maildir: %s", USER_MAILDIR)
     logging.debug("Archive folder: %s", ARCHIVE_FOLDER)
 
     # Verify the given paths are Maildirs
     maildir_paths = []
+    emlx_sources = []
+    mbox_paths = []
     for path in args.maildirs:
+        if args.mbox:
+            path = clean_path(path)
+            if os.path.isfile(path):
+                mbox_paths.append(path)
+                logging.info("+ added mbox %s" % (path,))
+            else:
+                logging.warning("%s: not an mbox file: %s" % (PROGRAM, path))
+            continue
+        
+        if args.emlx:
+            mailboxes = EmlxMailbox.find(clean_path(path), workers=args.parse_workers)
+            for mailbox in mailboxes:
+                logging.info("+ added mailbox %s" % (mailbox.path,))
+            if not mailboxes:
+                logging.warning("%s: no Apple Mail mailboxes in %s" % (PROGRAM, path))
+            emlx_sources.extend(mailboxes)
+            continue
+        
         logging.debug("* Checking path %r", path)
         
         path = clean_path(path)
@@ -108,16 +364,6 @@ def main(argc, argv):
             maildir = Maildir(path, fs_layout=USE_FS_LAYOUT)
             maildir_paths.append(path)
             logging.info("+ added folder %s" % (maildir.name,))
-            
-            if RECURSIVE:
-                logging.debug("_ scanning children")
-                for folder in maildir.list_folders():
-                    try:
-                        child = maildir.get_folder(folder)
-                        maildir_paths.append(child.path)
-                        logging.info("+   added subfolder of %s: %s" % (maildir.name, child.name,))
-                    except InvalidMaildirError as e:
-                        logging.info(e)
                     
         except InvalidMaildirError as e:
             print(e)
@@ -133,61 +379,179 @@ def main(argc, argv):
     del maildir
     
     # Verify the DB before starting
-    archive = MailArchive(ARCHIVE_PATH, create=True, lazy=True, fs_layout=USE_FS_LAYOUT)
+    archive = MailArchive(ARCHIVE_PATH, create=True, lazy=True, fs_layout=USE_FS_LAYOUT, compression=COMPRESSION,
+                            search=(args.index or args.index_bodies or None), index_bodies=args.index_bodies,
+                            hash_algorithm=args.hash, durability=args.durability, group_size=args.group_size, store=args.store, shared=(clean_path(args.shared_store) if args.shared_store else None))
     archive.maildir.lazy_period = 10
+    
+    # Statistics mode
+    if args.stats:
+        print_stats(archive.stats(), as_json=args.json)
+        archive.close()
+        return 0
+    
+    # Export mode
+    if args.export:
+        archive.export(clean_path(args.export), folders=args.folder, since=args.since, until=args.until, workers=args.workers)
+        archive.close()
+        return 0
+    
+    # Search mode
+    if args.search or args.sender or args.subject or args.after or args.before:
+        after = datetime.strptime(args.after, "%Y-%m-%d") if args.after else None
+        before = datetime.strptime(args.before, "%Y-%m-%d") if args.before else None
+        try:
+            for folder, msgid, content_hash in archive.search(args.search, sender=args.sender, subject=args.subject, since=after, until=before):
+                print("%s\t%s" % (folder, msgid))
+        except RuntimeError as e:
+            logging.error("%s: %s" % (PROGRAM, e))
+            archive.close()
+            return 1
+        archive.close()
+        return 0
+    
     if CHECK_ARCHIVE:
-        archive.check(True)
+        archive.check(True, throttle=throttle, folders=args.folder, since=args.since, until=args.until, hash_prefix=args.hash_prefix)
+    
+    # Content verification
+    if args.verify:
+        problems = archive.verify(sample=args.sample, seconds=args.verify_seconds, max_bytes=args.verify_bytes,
+                                  workers=args.workers or 4, quarantine=(args.quarantine and not DRY_RUN))
+        for key, folder, msgid, problem in problems:
+            print("%s\t%s\t%s\t%s" % (problem, folder, msgid, key))
+    
+    # Key migration
+    if args.migrate_hash is not None and not DRY_RUN:
+        archive.migrate_hash(budget=args.migrate_hash or None)
+    
+    if args.shared_gc and archive.shared is not None and not DRY_RUN:
+        logging.warning("* Removed %d unreferenced shared files", archive.shared.gc())
+    
+    if args.convert_store and not DRY_RUN:
+        archive.convert_store(args.convert_store)
+    
+    # Merge archives built elsewhere
+    for path in args.merge:
+        if not DRY_RUN:
+            other = MailArchive(clean_path(path), create=False, lazy=True, fs_layout=USE_FS_LAYOUT, search=False)
+            try:
+                archive.merge(other, mode=args.merge_mode)
+            finally:
+                other.close()
+    
+    # Pack maintenance
+    for folder in args.unpack:
+        if not DRY_RUN:
+            archive.unpack_folder(folder)
+    for folder in args.pack:
+        if not DRY_RUN:
+            archive.pack_folder(folder)
     
     # Import Maildirs
-    if not len(maildir_paths):
+    if not len(maildir_paths) and not len(emlx_sources) and not len(mbox_paths):
         logging.debug("- No maildirs given. Exiting.")
+        # Maintenance above may have queued index writes.
+        archive.close()
+        if events is not None:
+            events.close()
         return 0
+    
+    # mbox imports remember how far they got in the archive; a dry run archives nothing,
+    # so it must not move them.
+    checkpoints = None if DRY_RUN else os.path.join(ARCHIVE_PATH, "mbox-checkpoints.json")
+    mbox_sources = [MboxFile(path, checkpoints=checkpoints) for path in sorted(mbox_paths)]
+    for source in mbox_sources:
+        # A checkpoint must never get ahead of records still waiting for a group commit.
+        source.before_checkpoint = archive.flush
+        
+    # Subfolders are found on a thread pool while the import runs, so it starts at once.
+    def iter_maildir_paths():
+        for path in sorted(maildir_paths):
+            yield path
+            if RECURSIVE:
+                logging.debug("_ scanning children of %s", path)
+                for child in discover_maildirs(path, fs_layout=USE_FS_LAYOUT, workers=args.scan_workers):
+                    logging.info("+   added subfolder of %s: %s" % (path, child))
+                    yield child
+    
+    # Iterate over maildirs, then any Apple Mail mailboxes and mbox files
+    # Importers share the archive with each other, but not with fsck or packing.
+    with archive.lock.shared():
+        for path in itertools.chain(iter_maildir_paths(), emlx_sources, mbox_sources):
+            if STOP: break
         
-    # Iterate over maildirs
-    for path in sorted(maildir_paths):
-        if STOP: break
+            logging.debug("* Opening %r", path)
         
-        logging.debug("* Opening %r", path)
+            # Open the source
+            if isinstance(path, (EmlxMailbox, MboxFile)):
+                source = path
+            else:
+                try:
+                    source = Maildir(path, lazy=True, xattr=True, fs_layout=USE_FS_LAYOUT)
+                except InvalidMaildirError as e:
+                    logging.warning("%s: %s" % (PROGRAM, e.args))
+                    continue
+                source.lazy_period = 10
         
-        # Open the maildir
-        source = Maildir(path, lazy=True, xattr=True, fs_layout=USE_FS_LAYOUT)
-        source.lazy_period = 10
+            # Gather list of messages to check.
+            if isinstance(source, Maildir) and args.stream_listing:
+                # Huge directories: don't wait for the whole listing; the total is a guess.
+                msgids = None
+                msgcount = archive.listings.count(source.path) or estimate_entries(source.path)
+            elif isinstance(source, Maildir):
+                files = archive.listings.files(source)
+                msgids = [msgid for msgid, name in files]
+            else:
+                msgids = sorted(source.keys())
+            if msgids is not None:
+                msgcount = len(msgids)
         
-        # Gather list of messages to check.
-        msgids = sorted(source.keys())
-        msgcount = len(msgids)
+            logging.debug("* Found %r keys.", msgcount)
         
-        logging.debug("* Found %r keys.", msgcount)
+            if msgids is None:
+                messages = iter_maildir_stream(source.path, args.stream_threshold)
+            elif hasattr(source, "iter_messages"):
+                messages = source.iter_messages(msgids)
+            elif isinstance(source, Maildir):
+                if args.read_order != "name":
+                    names = dict(files)
+                    scheduled = ReadScheduler(source.path, args.read_order, args.prefetch)(msgids)
+                    files = ((msgid, names[msgid]) for msgid in scheduled)
+                messages = iter_maildir_files(source.path, files, args.stream_threshold)
+            else:
+                messages = iter_maildir(source, msgids, args.stream_threshold)
         
-        with Output(name=source.name, total=msgcount) as output:
-            for msgid in msgids:
-                result = EXISTING
-                
-                try:
-                    msg = source[msgid]
-                except KeyError:
-                    logging.error("%s: message not found" % (msgid,))
-                    output.increment(result)
-                    continue
-                
-                try:
-                    record = archive[msg]
-                    if record.should_update(msg):
-                        if DRY_RUN:
-                            result = UPDATED
+            with Output(name=source.name, total=msgcount) as output:
+                detailed = getattr(output, "detailed", False)
+                for msgid, msg in messages:
+                    if msg is None:
+                        if detailed:
+                            output.increment(MISSING, msgid=msgid)
                         else:
-                            result = archive.update_message(msg)
-                except KeyError:
-                    if DRY_RUN:
-                        result = ADDED
-                    else:
-                        result = archive.add_message(msg)
+                            output.increment(EXISTING)
+                        continue
                 
-                output.increment(result)
-                if STOP: break
+                    result = import_message(archive, msg, DRY_RUN)
+                    if detailed:
+                        output.increment(result, **message_details(archive, msgid, msg))
+                    else:
+                        output.increment(result)
+                    if throttle is not None:
+                        # Count the bytes read, and again if they were written to the archive.
+                        throttle.message(message_size(msg) * (2 if result == ADDED else 1))
+                    if STOP: break
+        
+            del messages
+            if isinstance(source, MboxFile):
+                source.close()
+            del source, msgids
         
-        del source, msgids
+        # Commit the last group while still holding the lock.
+        archive.flush()
     
+    archive.close()
+    if events is not None:
+        events.close()
     if STOP: return 1
 
 def start():
@@ -0,0 +1,184 @@
+import email
+import email.policy
+import logging
+import sqlite3
+import time
+
+from .locking import tune_sqlite
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT UNIQUE NOT NULL,
+    folder TEXT NOT NULL,
+    msgid TEXT NOT NULL,
+    date REAL
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5 (
+    sender, recipients, subject, body
+);
+"""
+
+def _header(headers, name):
+    try:
+        value = headers[name]
+    except (KeyError, TypeError):
+        return ""
+    return str(value) if value else ""
+
+
+def _body_text(content):
+    '''Extract the text/plain parts of a raw message.'''
+    if isinstance(content, str):
+        parsed = email.message_from_string(content, policy=email.policy.default)
+    else:
+        parsed = email.message_from_bytes(content, policy=email.policy.default)
+
+    parts = []
+    for part in parsed.walk():
+        if part.get_content_type() == "text/plain":
+            try:
+                parts.append(part.get_content())
+            except (LookupError, ValueError):
+                continue
+    return "\n".join(parts)
+
+
+class SearchIndex(object):
+    '''
+    An SQLite FTS5 index of message headers (and optionally body text) keyed by content hash.
+
+    Entries are queued and written in batches, one transaction per batch, so indexing
+    costs little per message during imports.
+    '''
+    path = None
+    bodies = False
+    batch_size = 500
+
+    def __init__(self, path, bodies=False, batch_size=None):
+        self.path = path
+        self.bodies = bodies
+        if batch_size:
+            self.batch_size = batch_size
+        self.pending = []
+
+        self.db = sqlite3.connect(path)
+        tune_sqlite(self.db)
+        self.db.executescript(SCHEMA)
+
+    def __contains__(self, content_hash):
+        if any(entry[0] == content_hash for entry in self.pending):
+            return True
+        row = self.db.execute("SELECT 1 FROM messages WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row is not None
+
+    def add(self, content_hash, folder, msgid, msg):
+        '''Queue a message for indexing; flushed once a batch fills.'''
+        headers = msg.headers
+        try:
+            date = time.mktime(msg.date.timetuple())
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            date = None
+
+        body = ""
+        if self.bodies and getattr(msg, "content", None):
+            body = _body_text(msg.content)
+
+        self.pending.append((
+            content_hash, folder, msgid, date,
+            _header(headers, "From"),
+            " ".join((_header(headers, "To"), _header(headers, "Cc"))).strip(),
+            _header(headers, "Subject"),
+            body,
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with self.db:
+            for content_hash, folder, msgid, date, sender, recipients, subject, body in self.pending:
+                self._delete(content_hash)
+                cursor = self.db.execute(
+                    "INSERT INTO messages (content_hash, folder, msgid, date) VALUES (?, ?, ?, ?)",
+                    (content_hash, folder, msgid, date))
+                self.db.execute(
+                    "INSERT INTO message_text (rowid, sender, recipients, subject, body) VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, sender, recipients, subject, body))
+        log.debug("indexed %d messages", len(self.pending))
+        self.pending = []
+
+    def _delete(self, content_hash):
+        row = self.db.execute("SELECT id FROM messages WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM message_text WHERE rowid = ?", row)
+            self.db.execute("DELETE FROM messages WHERE id = ?", row)
+
+    def remove(self, content_hash):
+        self.flush()
+        with self.db:
+            self._delete(content_hash)
+
+    def move(self, content_hash, folder, msgid=None):
+        '''Follow a message that was moved to another folder.'''
+        self.flush()
+        with self.db:
+            if msgid:
+                self.db.execute("UPDATE messages SET folder = ?, msgid = ? WHERE content_hash = ?", (folder, msgid, content_hash))
+            else:
+                self.db.execute("UPDATE messages SET folder = ? WHERE content_hash = ?", (folder, content_hash))
+
+    def rekey(self, old_hash, new_hash):
+        '''Follow a record whose key changed (e.g. during a hash migration).'''
+        if old_hash == new_hash:
+            return
+        self.flush()
+        with self.db:
+            self._delete(new_hash)
+            self.db.execute("UPDATE messages SET content_hash = ? WHERE content_hash = ?", (new_hash, old_hash))
+
+    def search(self, query=None, sender=None, subject=None, since=None, until=None, limit=None):
+        '''
+        Yield (folder, msgid, content_hash) for matching messages, newest first.
+        query is an FTS5 match expression; since and until are datetimes.
+        '''
+        self.flush()
+
+        matches = []
+        if query:
+            matches.append(query)
+        if sender:
+            matches.append('sender:"%s"' % sender.replace('"', '""'))
+        if subject:
+            matches.append('subject:"%s"' % subject.replace('"', '""'))
+
+        sql = "SELECT m.folder, m.msgid, m.content_hash FROM messages m"
+        where = []
+        params = []
+        if matches:
+            sql += " JOIN message_text t ON t.rowid = m.id"
+            where.append("message_text MATCH ?")
+            params.append(" AND ".join("(%s)" % m for m in matches))
+        if since:
+            where.append("m.date >= ?")
+            params.append(time.mktime(since.timetuple()))
+        if until:
+            where.append("m.date < ?")
+            params.append(time.mktime(until.timetuple()))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY m.date DESC"
+        if limit:
+            sql += " LIMIT %d" % int(limit)
+
+        for row in self.db.execute(sql, params):
+            yield row
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,115 @@
+import errno
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from .locking import tune_sqlite
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS refs (
+    content_hash TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    PRIMARY KEY (content_hash, archive)
+);
+"""
+
+
+class SharedStore(object):
+    '''
+    Single-instance storage shared by several archives on one filesystem.  Each message
+    body is kept once under objects/, keyed by its archive key, and every archive holding
+    it has a hard link in its own folder.  refs.db counts which archives reference each
+    object; when the last one lets go the object is removed.
+
+    Hard links share an inode, so a shared file's mtime is the earliest any archive has
+    set and its compression is whatever the first archive wrote; archives keep their own
+    flags (in the file name) and dates (in their records).
+    '''
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "refs.db"), isolation_level=None)
+        tune_sqlite(self.db)
+        self.db.executescript(SCHEMA)
+
+    def _path(self, key):
+        name = key.replace(":", "-")
+        return os.path.join(self.root, "objects", name[-2:], name)
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so linking and releasing are serialised.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def refcount(self, key):
+        return self.db.execute("SELECT COUNT(*) FROM refs WHERE content_hash = ?", (key,)).fetchone()[0]
+
+    def link(self, key, archive, dst):
+        '''Hard-link the stored copy of key to dst for archive; False if there is none.'''
+        with self._transaction() as db:
+            try:
+                os.link(self._path(key), dst)
+            except FileNotFoundError:
+                return False
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EMLINK):
+                    log.debug("cannot link shared %s: %s", key, e)
+                    return False
+                raise
+            db.execute("INSERT OR IGNORE INTO refs (content_hash, archive) VALUES (?, ?)", (key, archive))
+        return True
+
+    def publish(self, key, archive, path):
+        '''Share an archive's file for key, or just count the reference if it is already shared.'''
+        target = self._path(key)
+        with self._transaction() as db:
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                try:
+                    os.link(path, target)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EMLINK):
+                        raise
+                    log.debug("cannot share %s: %s", key, e)
+                    return False
+            db.execute("INSERT OR IGNORE INTO refs (content_hash, archive) VALUES (?, ?)", (key, archive))
+        return True
+
+    def release(self, key, archive):
+        '''Drop archive's reference to key, removing the stored copy once nobody holds it.'''
+        with self._transaction() as db:
+            db.execute("DELETE FROM refs WHERE content_hash = ? AND archive = ?", (key, archive))
+            if not db.execute("SELECT 1 FROM refs WHERE content_hash = ? LIMIT 1", (key,)).fetchone():
+                try:
+                    os.remove(self._path(key))
+                    log.debug("- shared copy of %s released", key)
+                except FileNotFoundError:
+                    pass
+
+    def gc(self):
+        '''Remove stored copies no archive references (e.g. left by a crash); returns the count.'''
+        removed = 0
+        objects = os.path.join(self.root, "objects")
+        for sub in os.listdir(objects):
+            for name in os.listdir(os.path.join(objects, sub)):
+                key = name.replace("-", ":", 1)
+                with self._transaction() as db:
+                    if not db.execute("SELECT 1 FROM refs WHERE content_hash = ? LIMIT 1", (key,)).fetchone():
+                        os.remove(os.path.join(objects, sub, name))
+                        removed += 1
+        return removed
+
+    def close(self):
+        self.db.close()
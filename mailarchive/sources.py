@@ -0,0 +1,373 @@
+import bisect
+import email
+import email.parser
+import email.policy
+import email.utils
+import fcntl
+import json
+import logging
+import mmap
+import os
+import plistlib
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from .hashing import LEGACY, content_key, hasher, make_key
+
+log = logging.getLogger(__name__)
+
+
+class SourceMessage(object):
+    '''
+    A message read from a non-Maildir source.  It offers the same attributes the
+    archive uses on Maildir messages, so it goes through the same add/update path.
+    '''
+    def __init__(self, msgid, content, flags="", mtime=None):
+        self.msgid = msgid
+        self.content = content
+        self.flags = "".join(sorted(set(flags)))
+        self.keys = {}
+        self._headers = None
+        self._date = None
+        self.mtime = mtime
+
+    def key(self, algorithm):
+        '''The archive key under a hash algorithm, computed once.'''
+        if algorithm not in self.keys:
+            self.keys[algorithm] = self._key(algorithm)
+        return self.keys[algorithm]
+
+    def _key(self, algorithm):
+        return content_key(algorithm, self.content)
+
+    @property
+    def content_hash(self):
+        return self.key(LEGACY)
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            parser = email.parser.BytesHeaderParser(policy=email.policy.compat32)
+            content = self.content
+            if isinstance(content, str):
+                content = content.encode("utf-8", "surrogateescape")
+            self._headers = parser.parsebytes(content)
+        return self._headers
+
+    @property
+    def date(self):
+        if self._date is None:
+            try:
+                self._date = email.utils.parsedate_to_datetime(self.headers["Date"])
+            except (TypeError, ValueError, IndexError):
+                self._date = datetime.fromtimestamp(self.mtime or 0)
+            if self.mtime is None:
+                self.mtime = self._date.timestamp()
+        return self._date
+
+    def add_flags(self, flags):
+        self.flags = "".join(sorted(set(self.flags).union(set(flags))))
+
+
+# Apple Mail message flag bits and their Maildir equivalents.
+EMLX_FLAGS = (
+    (1 << 0, "S"),  # read
+    (1 << 1, "T"),  # deleted
+    (1 << 2, "R"),  # answered
+    (1 << 4, "F"),  # flagged
+    (1 << 6, "D"),  # draft
+    (1 << 8, "P"),  # forwarded (passed)
+)
+
+
+def emlx_flags(value):
+    return "".join(flag for bit, flag in EMLX_FLAGS if value & bit)
+
+
+def parse_emlx(path):
+    '''
+    Parse an .emlx or .partial.emlx file into (content, flags, mtime).
+    The format is a byte count line, the RFC 822 message, then an XML plist of metadata.
+    '''
+    with open(path, "rb") as f:
+        length = int(f.readline().strip())
+        content = f.read(length)
+        trailer = f.read()
+
+    flags = ""
+    mtime = None
+    try:
+        meta = plistlib.loads(trailer)
+        flags = emlx_flags(int(meta.get("flags", 0)))
+        if "date-received" in meta:
+            mtime = float(meta["date-received"])
+    except (plistlib.InvalidFileException, ValueError, TypeError):
+        log.debug("unreadable emlx metadata in %s", path)
+
+    if mtime is None:
+        mtime = os.stat(path).st_mtime
+    return content, flags, mtime
+
+
+def _parse_emlx_entry(path):
+    try:
+        return parse_emlx(path)
+    except (OSError, ValueError) as e:
+        log.error("%s: %s", path, e)
+        return None
+
+
+def _parse_emlx_chunk(paths):
+    return [_parse_emlx_entry(path) for path in paths]
+
+
+class EmlxMailbox(object):
+    '''
+    A Mail.app mailbox (a "*.mbox" directory) as an archive source.  Messages are keyed
+    by their path relative to the mailbox and parsed in a process pool.
+    '''
+    suffixes = (".emlx", ".partial.emlx")
+    chunk_size = 64
+
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path.rstrip("/")))[0]
+        self.workers = workers
+
+    @classmethod
+    def find(cls, root, workers=None):
+        '''Find every mailbox in a Mail.app tree (e.g. ~/Library/Mail/V*).'''
+        mailboxes = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Skip Mail.app's internal "Messages" directories, but not "Sent Messages.mbox".
+            if dirpath.endswith(".mbox") and "Messages" not in dirpath.split(os.sep):
+                mailboxes.append(cls(dirpath, workers=workers))
+        return sorted(mailboxes, key=lambda m: m.path)
+
+    def keys(self):
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            # Nested mailboxes are sources of their own.
+            dirnames[:] = [d for d in dirnames if not d.endswith(".mbox")]
+            for filename in filenames:
+                if filename.endswith(self.suffixes):
+                    keys.append(os.path.relpath(os.path.join(dirpath, filename), self.path))
+        return keys
+
+    def __getitem__(self, msgid):
+        try:
+            content, flags, mtime = parse_emlx(os.path.join(self.path, msgid))
+        except (OSError, ValueError):
+            raise KeyError(msgid)
+        return SourceMessage(msgid, content, flags, mtime)
+
+    def iter_messages(self, msgids):
+        '''
+        Yield (msgid, message) in order, parsing in a process pool; message is None on
+        failure.  Only a few chunks per worker are in flight, so parsing never runs far
+        ahead of the import.
+        '''
+        workers = self.workers or os.cpu_count() or 1
+        window = deque()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(msgids), self.chunk_size):
+                chunk = msgids[start:start + self.chunk_size]
+                paths = [os.path.join(self.path, msgid) for msgid in chunk]
+                window.append((chunk, pool.submit(_parse_emlx_chunk, paths)))
+                if len(window) > workers * 2:
+                    for item in self._drain(*window.popleft()):
+                        yield item
+            while window:
+                for item in self._drain(*window.popleft()):
+                    yield item
+
+    def _drain(self, chunk, future):
+        for msgid, parsed in zip(chunk, future.result()):
+            if parsed is None:
+                yield msgid, None
+            else:
+                yield msgid, SourceMessage(msgid, *parsed)
+
+
+# mbox Status/X-Status letters and their Maildir equivalents.
+MBOX_FLAGS = {"R": "S", "A": "R", "F": "F", "D": "T"}
+
+
+class MappedMessage(SourceMessage):
+    '''
+    A message inside a memory-mapped mbox.  The hash is taken straight from the mapped
+    slice; the bytes are only copied out if the message is actually written to the archive.
+    '''
+    def __init__(self, mbox, msgid, start, end, flags="", mtime=None):
+        SourceMessage.__init__(self, msgid, None, flags, mtime)
+        self.mbox = mbox
+        self.start = start
+        self.end = end
+        self._content = None
+
+        # mboxrd quoting has to be undone before hashing, which needs a copy; most messages have none.
+        self.quoted = mbox.map.find(b">From ", start, end) != -1
+
+    @property
+    def content(self):
+        if self._content is None:
+            if self.quoted:
+                self._content = unquote_from(self.mbox.map[self.start:self.end])
+            else:
+                return self.mbox.map[self.start:self.end]
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    def _key(self, algorithm):
+        if self._content is not None or self.quoted:
+            return content_key(algorithm, self.content)
+        h = hasher(algorithm)
+        with memoryview(self.mbox.map) as view:
+            h.update(view[self.start:self.end])
+        return make_key(algorithm, h.hexdigest())
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            split = self.mbox.map.find(b"\n\n", self.start, self.end)
+            end = self.end if split == -1 else split + 1
+            parser = email.parser.BytesHeaderParser(policy=email.policy.compat32)
+            self._headers = parser.parsebytes(self.mbox.map[self.start:end])
+        return self._headers
+
+
+QUOTED_FROM = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+
+def unquote_from(data):
+    '''Undo mboxrd ">From " quoting.'''
+    return QUOTED_FROM.sub(rb"\1", data)
+
+
+class MboxFile(object):
+    '''
+    A (possibly multi-gigabyte) mbox file as an archive source.  The file is memory-mapped
+    and message boundaries found in one scan.  Keys are zero-padded byte offsets so they
+    sort in file order, and progress is checkpointed so interrupted imports resume.
+    '''
+    checkpoint_interval = 1000
+
+    # Called before each checkpoint, so whatever the checkpoint covers is committed first.
+    before_checkpoint = None
+
+    def __init__(self, path, checkpoints=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.checkpoints = checkpoints
+        self.map = None
+        self.boundaries = None
+
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self.map, "madvise"):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def _scan(self):
+        '''Find the offset of every "From " envelope line.'''
+        if self.boundaries is None:
+            self.boundaries = []
+            if self.map is not None:
+                pos = 0 if self.map[:5] == b"From " else self.map.find(b"\nFrom ")
+                while pos != -1:
+                    if self.map[pos:pos + 1] == b"\n":
+                        pos += 1
+                    self.boundaries.append(pos)
+                    pos = self.map.find(b"\nFrom ", pos)
+            log.debug("found %d messages in %s", len(self.boundaries), self.path)
+        return self.boundaries
+
+    def _load_checkpoint(self):
+        if not self.checkpoints or not os.path.exists(self.checkpoints):
+            return 0
+        with open(self.checkpoints, "r") as f:
+            state = json.load(f).get(self.path)
+        # A file that shrank was rewritten; start over.
+        if not state or state["size"] > len(self.map or b""):
+            return 0
+        return state["offset"]
+
+    def _save_checkpoint(self, offset):
+        if not self.checkpoints:
+            return
+        if self.before_checkpoint is not None:
+            self.before_checkpoint()
+        # Importers of other mbox files may share the checkpoint file.
+        with open(self.checkpoints + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {}
+            if os.path.exists(self.checkpoints):
+                with open(self.checkpoints, "r") as f:
+                    state = json.load(f)
+            state[self.path] = {"offset": offset, "size": len(self.map or b"")}
+            tmp = "%s.%d.tmp" % (self.checkpoints, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.rename(tmp, self.checkpoints)
+
+    def keys(self):
+        resume = self._load_checkpoint()
+        if resume:
+            log.info("resuming %s at offset %d", self.path, resume)
+        return ["%016d" % offset for offset in self._scan() if offset >= resume]
+
+    def _message(self, msgid):
+        start = int(msgid)
+        boundaries = self._scan()
+        i = bisect.bisect_left(boundaries, start)
+        if i == len(boundaries) or boundaries[i] != start:
+            raise KeyError(msgid)
+        end = boundaries[i + 1] if i + 1 < len(boundaries) else len(self.map)
+
+        # Split off the envelope line; its date is the best mtime an mbox has.
+        newline = self.map.find(b"\n", start, end)
+        envelope = self.map[start:newline].decode("ascii", "replace")
+        body_end = end - 1 if self.map[end - 1:end] == b"\n" and end < len(self.map) else end
+        try:
+            mtime = time.mktime(time.strptime(" ".join(envelope.split()[-5:]), "%a %b %d %H:%M:%S %Y"))
+        except (ValueError, OverflowError):
+            mtime = None
+
+        msg = MappedMessage(self, msgid, newline + 1, body_end, mtime=mtime)
+        status = (msg.headers["Status"] or "") + (msg.headers["X-Status"] or "")
+        msg.flags = "".join(sorted(set(MBOX_FLAGS[c] for c in status if c in MBOX_FLAGS)))
+        if msg.mtime is None:
+            msg.mtime = msg.date.timestamp()
+        return msg, end
+
+    def __getitem__(self, msgid):
+        return self._message(msgid)[0]
+
+    def iter_messages(self, msgids):
+        '''Yield (msgid, message), checkpointing the offset of the last message handed back.'''
+        position = None
+        count = 0
+        try:
+            for msgid in msgids:
+                msg, end = self._message(msgid)
+                yield msgid, msg
+                position = end
+                count += 1
+                if count % self.checkpoint_interval == 0:
+                    self._save_checkpoint(position)
+        finally:
+            if position is not None:
+                self._save_checkpoint(position)
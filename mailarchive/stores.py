@@ -0,0 +1,271 @@
+import contextlib
+import dbm
+import logging
+import os
+
+from simplekvs import SQLiteStore
+
+from .locking import enable_wal
+
+log = logging.getLogger(__name__)
+
+# Memory-mapped B+tree store; optional.
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+# Chunk size for ordered iteration, so a scan never pins one read transaction for long.
+SCAN_CHUNK = 1000
+
+# The record store interface.  simplekvs.SQLiteStore defines it and the other backends
+# here follow it, so MailArchive works with any of them:
+#
+#     store[key]                  get; KeyError if missing
+#     store[key] = value          insert; KeyError if the key exists
+#     del store[key]              delete
+#     key in store, len(store)
+#     iter(store), store.keys()   every key (in sorted order for the backends here)
+#     with store as transaction:  one atomic batch; the transaction supports all of the
+#         transaction.set(k, v)   above plus upsert and delete, and the store itself
+#         transaction.delete(k)   reads and writes through it while it is open
+#
+# batch_write() and copy_store() are written against the interface only.
+
+
+def batch_write(store, items, batch_size=10000):
+    '''Upsert (key, value) pairs, one transaction per batch_size; returns the count.'''
+    count = 0
+    items = iter(items)
+    while True:
+        wrote = 0
+        with store as transaction:
+            for key, value in items:
+                transaction.set(key, value)
+                wrote += 1
+                if wrote >= batch_size:
+                    break
+        count += wrote
+        if wrote < batch_size:
+            return count
+
+
+def copy_store(src, dst, batch_size=10000):
+    '''Copy every record from one store to another, e.g. to change backends.'''
+    def items():
+        for key in src:
+            if key is None:
+                continue
+            try:
+                yield key, src[key]
+            except KeyError:
+                continue
+    return batch_write(dst, items(), batch_size)
+
+
+class LMDBStore(object):
+    '''
+    Records in an LMDB file.  Reads are served straight from a shared memory map without
+    copying through a page cache of our own, which suits lookup-heavy runs like a no-op
+    re-import.  Keys are kept sorted; writers are serialised by LMDB, readers never block.
+    '''
+    map_size = 1 << 40  # Address space only; the file grows as needed.
+
+    def __init__(self, path):
+        if lmdb is None:
+            raise RuntimeError("the lmdb store needs the lmdb package")
+        self.path = path
+        self.env = lmdb.open(path, subdir=False, map_size=self.map_size, readahead=False, max_dbs=0)
+        self.txn = None
+
+    def _read(self):
+        return contextlib.nullcontext(self.txn) if self.txn is not None else self.env.begin()
+
+    def _write(self):
+        return contextlib.nullcontext(self.txn) if self.txn is not None else self.env.begin(write=True)
+
+    def __enter__(self):
+        if self.txn is not None:
+            raise RuntimeError("nested store transactions are not supported")
+        self.txn = self.env.begin(write=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        txn, self.txn = self.txn, None
+        if exc_type is None:
+            txn.commit()
+        else:
+            txn.abort()
+
+    def __getitem__(self, key):
+        with self._read() as txn:
+            value = txn.get(key.encode("utf-8"))
+        if value is None:
+            raise KeyError(key)
+        return value.decode("utf-8")
+
+    def __setitem__(self, key, value):
+        with self._write() as txn:
+            if not txn.put(key.encode("utf-8"), value.encode("utf-8"), overwrite=False):
+                raise KeyError(key)
+
+    def __delitem__(self, key):
+        with self._write() as txn:
+            if not txn.delete(key.encode("utf-8")):
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        with self._read() as txn:
+            return txn.get(key.encode("utf-8")) is not None
+
+    def __len__(self):
+        with self._read() as txn:
+            return txn.stat()["entries"]
+
+    def set(self, key, value):
+        with self._write() as txn:
+            txn.put(key.encode("utf-8"), value.encode("utf-8"))
+
+    def delete(self, key):
+        with self._write() as txn:
+            txn.delete(key.encode("utf-8"))
+
+    def __iter__(self):
+        # Resume from the last key each chunk, so records may be changed while iterating.
+        last = None
+        while True:
+            chunk = []
+            with self._read() as txn:
+                cursor = txn.cursor()
+                found = cursor.set_range(last) if last is not None else cursor.first()
+                while found and len(chunk) < SCAN_CHUNK:
+                    key = cursor.key()
+                    if key != last:
+                        chunk.append(key)
+                    found = cursor.next()
+            if not chunk:
+                return
+            for key in chunk:
+                yield key.decode("utf-8")
+            last = chunk[-1]
+
+    def keys(self):
+        return list(self)
+
+    def close(self):
+        self.env.close()
+
+
+class DBMStore(object):
+    '''
+    Records in the best dbm the platform has (gdbm memory-maps its file).  dbm has no
+    transactions, so a transaction's writes are buffered and applied together when it
+    ends, and no order, so iteration sorts the keys.  gdbm allows a single writer: use it
+    for archives with one importer at a time.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.db = dbm.open(path, "c")
+        self.pending = None
+
+    def __enter__(self):
+        if self.pending is not None:
+            raise RuntimeError("nested store transactions are not supported")
+        self.pending = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pending, self.pending = self.pending, None
+        if exc_type is not None:
+            return
+        for key, value in pending.items():
+            if value is None:
+                if key in self.db: del self.db[key]
+            else:
+                self.db[key] = value
+        if hasattr(self.db, "sync"):
+            self.db.sync()
+
+    def _get(self, key):
+        key = key.encode("utf-8")
+        if self.pending is not None and key in self.pending:
+            return self.pending[key]
+        return self.db.get(key)
+
+    def _put(self, key, value):
+        key = key.encode("utf-8")
+        if self.pending is not None:
+            self.pending[key] = value
+        elif value is None:
+            if key in self.db: del self.db[key]
+        else:
+            self.db[key] = value
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is None:
+            raise KeyError(key)
+        return value.decode("utf-8")
+
+    def __setitem__(self, key, value):
+        if self._get(key) is not None:
+            raise KeyError(key)
+        self._put(key, value.encode("utf-8"))
+
+    def __delitem__(self, key):
+        if self._get(key) is None:
+            raise KeyError(key)
+        self._put(key, None)
+
+    def __contains__(self, key):
+        return self._get(key) is not None
+
+    def __len__(self):
+        return len(self._keyset())
+
+    def set(self, key, value):
+        self._put(key, value.encode("utf-8"))
+
+    def delete(self, key):
+        self._put(key, None)
+
+    def _keyset(self):
+        keys = set(self.db.keys())
+        if self.pending:
+            for key, value in self.pending.items():
+                if value is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return keys
+
+    def keys(self):
+        return sorted(key.decode("utf-8") for key in self._keyset())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def close(self):
+        self.db.close()
+
+
+def _open_sqlite(path):
+    # WAL lets concurrent importers read while one of them writes.
+    enable_wal(path)
+    return SQLiteStore(path)
+
+
+BACKENDS = {
+    "sqlite": ("archive.db", _open_sqlite),
+    "lmdb": ("archive.lmdb", LMDBStore),
+    "dbm": ("archive.dbm", DBMStore),
+}
+
+
+def open_store(root, backend="sqlite"):
+    '''Open (creating if needed) an archive's record store with the named backend.'''
+    try:
+        filename, opener = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("unknown store backend: %r" % (backend,))
+    return opener(os.path.join(root, filename))
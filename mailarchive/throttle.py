@@ -0,0 +1,115 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import time
+
+log = logging.getLogger(__name__)
+
+# linux/ioprio.h
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+
+
+def set_ioprio(ioclass="idle", level=7):
+    '''Lower this process's I/O priority (Linux only); returns True if it took effect.'''
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None or not platform.system() == "Linux":
+        log.warning("I/O priority is not supported on this platform")
+        return False
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    value = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | (level if ioclass != "idle" else 0)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        log.warning("ioprio_set failed: %s", os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+
+class TokenBucket(object):
+    '''
+    Allows rate units per second on average, with bursts up to burst units.  Debt is
+    allowed, so a single large message is never refused; the caller just waits longer.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def consume(self, amount, scale=1.0):
+        '''Take amount tokens, sleeping if the bucket is in debt.  scale < 1 slows the refill.'''
+        now = time.monotonic()
+        rate = self.rate * scale
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            wait = -self.tokens / rate
+            time.sleep(wait)
+            return wait
+        return 0.0
+
+
+class Throttle(object):
+    '''
+    Paces the archiver on a live server: caps bytes per second (read plus written) and
+    messages per second, and in adaptive mode backs off while per-message latency runs
+    well above the best it has seen, which is how a busy disk shows up.
+    '''
+    # How far above the baseline latency counts as contention, and how hard to back off.
+    contention = 2.0
+    floor = 1.0 / 16
+
+    def __init__(self, bytes_per_sec=None, msgs_per_sec=None, adaptive=False):
+        self.bytes = TokenBucket(bytes_per_sec, bytes_per_sec) if bytes_per_sec else None
+        self.msgs = TokenBucket(msgs_per_sec, max(1, msgs_per_sec)) if msgs_per_sec else None
+        self.adaptive = adaptive
+        self.scale = 1.0
+        self.baseline = None
+        self.average = None
+        self.last = time.monotonic()
+        self.slept = 0.0
+
+    @classmethod
+    def from_options(cls, bytes_per_sec=None, msgs_per_sec=None, adaptive=False):
+        '''A Throttle, or None when nothing is limited so callers can skip it entirely.'''
+        if not (bytes_per_sec or msgs_per_sec or adaptive):
+            return None
+        return cls(bytes_per_sec, msgs_per_sec, adaptive)
+
+    def _observe(self, latency):
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = max(latency, 1e-6)
+        self.average = latency if self.average is None else self.average * 0.9 + latency * 0.1
+
+        if self.average > self.baseline * self.contention:
+            self.scale = max(self.floor, self.scale * 0.5)
+        elif self.scale < 1.0:
+            self.scale = min(1.0, self.scale * 1.1)
+
+        # Let the baseline drift up slowly so one lucky early read doesn't pin it forever.
+        self.baseline *= 1.001
+
+    def message(self, nbytes=0):
+        '''Account for one processed message and sleep as the limits require.'''
+        now = time.monotonic()
+        latency = now - self.last
+
+        slept = 0.0
+        if self.adaptive:
+            self._observe(latency)
+            if self.scale < 1.0 and not (self.bytes or self.msgs):
+                # No explicit caps: stretch each message's work by the back-off factor.
+                slept = latency * (1.0 / self.scale - 1.0)
+                time.sleep(slept)
+        if self.msgs:
+            slept += self.msgs.consume(1, self.scale)
+        if self.bytes and nbytes:
+            slept += self.bytes.consume(nbytes, self.scale)
+
+        self.slept += slept
+        self.last = time.monotonic()
@@ -0,0 +1,176 @@
+'''
+The durability ordering: a record is never committed before its message file and the
+directory entry naming it have been synced.  fsyncs and store writes are recorded in one
+event log, with a fake store and a spy in place of fsync_path.
+'''
+import os
+
+import pytest
+
+from mailarchive import durability
+from mailarchive.durability import Durability
+
+
+class FakeStore(object):
+    '''Just enough of the record store interface; every commit is logged.'''
+    def __init__(self, events):
+        self.events = events
+        self.data = {}
+        self.open = None
+
+    def __enter__(self):
+        self.open = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pending, self.open = self.open, None
+        if exc_type is None and pending:
+            self.data.update(pending)
+            self.events.append(("commit", tuple(sorted(pending))))
+
+    def __contains__(self, key):
+        return key in (self.open or {}) or key in self.data
+
+    def __getitem__(self, key):
+        if self.open and key in self.open:
+            return self.open[key]
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            raise KeyError(key)
+        self.data[key] = value
+        self.events.append(("commit", (key,)))
+
+    def set(self, key, value):
+        self.open[key] = value
+
+
+class FakeFolderIndex(object):
+    def set(self, key, folder):
+        pass
+
+    def remove(self, key):
+        pass
+
+
+@pytest.fixture
+def events(monkeypatch):
+    log = []
+
+    def fsync_path(path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        log.append(("fsync", path))
+
+    monkeypatch.setattr(durability, "fsync_path", fsync_path)
+    return log
+
+
+def message_file(tmp_path, name):
+    cur = tmp_path / "cur"
+    cur.mkdir(exist_ok=True)
+    path = cur / name
+    path.write_bytes(b"Subject: test\n\nbody\n")
+    return str(path)
+
+
+def test_strict_syncs_file_then_directory(events, tmp_path):
+    path = message_file(tmp_path, "1")
+    Durability("strict").sync(path)
+    assert events == [("fsync", path), ("fsync", os.path.dirname(path))]
+
+
+def test_group_syncs_files_then_each_directory_once(events, tmp_path):
+    d = Durability("group", group_size=10)
+    paths = [message_file(tmp_path, str(i)) for i in range(3)]
+    for path in paths:
+        d.touch(path)
+    assert events == []
+
+    d.sync_group()
+    assert events == [("fsync", path) for path in paths] + [("fsync", os.path.dirname(paths[0]))]
+    assert d.files == [] and d.started is None
+
+
+def test_group_skips_files_moved_since(events, tmp_path):
+    d = Durability("group")
+    path = message_file(tmp_path, "1")
+    d.touch(path)
+    os.remove(path)
+    d.sync_group()
+    assert events == []
+
+
+def test_none_never_syncs(events, tmp_path):
+    d = Durability("none")
+    path = message_file(tmp_path, "1")
+    d.sync(path)
+    d.touch(path)
+    d.sync_group()
+    d.sync_paths([path], [str(tmp_path)])
+    assert events == []
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        Durability("sometimes")
+
+
+@pytest.fixture
+def archive():
+    # The archive's side of the ordering needs the real dependencies to import.
+    return pytest.importorskip("mailarchive.archive")
+
+
+def fake_archive(archive, events, mode, group_size=1000):
+    a = archive.MailArchive.__new__(archive.MailArchive)
+    a.durability = Durability(mode, group_size=group_size)
+    a.pending = {}
+    a.store = FakeStore(events)
+    a.folder_index = FakeFolderIndex()
+    a.search_index = None
+    a.shared = None
+    return a
+
+
+def record(archive, key, msgid):
+    return archive.MailArchiveRecord(content_hash=key, msgid=msgid, flags="S", mtime=1, folder="/Archive/2020")
+
+
+def test_strict_commit_follows_sync(archive, events, tmp_path):
+    a = fake_archive(archive, events, "strict")
+    path = message_file(tmp_path, "1")
+    a._commit_record(record(archive, "k1", "1"), path)
+    assert events == [("fsync", path), ("fsync", os.path.dirname(path)), ("commit", ("k1",))]
+
+
+def test_group_commit_follows_sync_of_whole_group(archive, events, tmp_path):
+    a = fake_archive(archive, events, "group", group_size=2)
+    first = message_file(tmp_path, "1")
+    second = message_file(tmp_path, "2")
+
+    a._commit_record(record(archive, "k1", "1"), first)
+    assert events == []
+
+    # The second record fills the group.
+    a._commit_record(record(archive, "k2", "2"), second)
+    assert events == [("fsync", first), ("fsync", second), ("fsync", os.path.dirname(first)),
+                      ("commit", ("k1", "k2"))]
+    assert a.pending == {}
+
+
+def test_pending_records_are_read_without_committing(archive, events, tmp_path):
+    a = fake_archive(archive, events, "group")
+    a._commit_record(record(archive, "k1", "1"), message_file(tmp_path, "1"))
+
+    class Message(object):
+        content_hash = "k1"
+
+    a.hash_algorithm = archive.LEGACY
+    a.previous_hash = None
+    assert a[Message()].msgid == "1"
+    assert events == []
+
+    a.flush()
+    assert events[-1] == ("commit", ("k1",))